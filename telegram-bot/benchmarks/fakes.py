@@ -0,0 +1,459 @@
+"""In-process stand-ins for Telegram, Anthropic and Google Calendar.
+
+Each fake takes a :class:`Faults` that adds latency and injects errors
+from a seeded random generator, so a run is reproducible offline.
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+import httplib2
+from googleapiclient.errors import HttpError
+from telegram.error import NetworkError
+
+from event_cache import LOCAL_TZ, event_bounds
+from helpers.intent_parser import parse_intent
+
+TITLES = (
+    "ישיבת צוות", "תדריך בוקר", "תרגיל טכני", "שיחה עם המפקד", "סקירת נשק",
+    "אימון סונר", "ביקורת סגל", "תכנון מבצעים", "ארוחת צהריים", "סיור גנק",
+)
+COLOR_IDS = ("", "1", "2", "3", "4", "5", "6", "8", "10", "11")
+
+
+class Faults:
+    """Latency (``latency`` ± ``jitter`` seconds) and an error rate."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    def delay(self) -> float:
+        self.calls += 1
+        if not self.latency and not self.jitter:
+            return 0.0
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self) -> bool:
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+def make_events(count: int, start: datetime, span: timedelta, seed: int = 0) -> list:
+    """``count`` timed events spread over ``[start, start + span)``."""
+    rnd = random.Random(seed)
+    events = []
+    for i in range(count):
+        begin = start + timedelta(seconds=rnd.uniform(0, span.total_seconds()))
+        begin = begin.replace(second=0, microsecond=0)
+        end = begin + timedelta(minutes=rnd.choice((15, 30, 45, 60, 90)))
+        event = {
+            "id": f"ev{i:06d}",
+            "summary": f"{rnd.choice(TITLES)} {i}",
+            "start": {"dateTime": begin.astimezone(LOCAL_TZ).isoformat(), "timeZone": "Asia/Jerusalem"},
+            "end": {"dateTime": end.astimezone(LOCAL_TZ).isoformat(), "timeZone": "Asia/Jerusalem"},
+            "updated": "2020-01-01T00:00:00.000Z",
+            "etag": '"0"',
+            "status": "confirmed",
+        }
+        color = rnd.choice(COLOR_IDS)
+        if color:
+            event["colorId"] = color
+        events.append(event)
+    return events
+
+
+# Google Calendar
+
+
+def _http_error(status: int) -> HttpError:
+    resp = httplib2.Response({"status": status})
+    resp.reason = "Injected"
+    return HttpError(resp, json.dumps({"error": {"code": status}}).encode())
+
+
+def _parse_rfc3339(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class FakeRequest:
+    """Mimics ``googleapiclient.http.HttpRequest``: ``execute()``, ``headers``
+    and ``methodId``."""
+
+    def __init__(self, calendar, handler, method_id: str = "", **params):
+        self._calendar = calendar
+        self._handler = handler
+        self._params = params
+        self.headers = {}
+        self.methodId = method_id
+
+    def execute(self, num_retries: int = 0):
+        faults = self._calendar.faults
+        time.sleep(faults.delay())
+        if faults.should_fail():
+            raise _http_error(503)
+        with self._calendar.lock:
+            return self._handler(headers=self.headers, **self._params)
+
+
+class FakeBatch:
+    def __init__(self, calendar, callback):
+        self._calendar = calendar
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request_id or str(len(self._requests)), request))
+
+    def execute(self):
+        # One round trip for the whole batch.
+        time.sleep(self._calendar.faults.delay())
+        for request_id, request in self._requests:
+            try:
+                with self._calendar.lock:
+                    response = request._handler(headers=request.headers, **request._params)
+                self._callback(request_id, response, None)
+            except HttpError as e:
+                self._callback(request_id, None, e)
+
+
+class FakeCalendar:
+    """One user's calendar behind the subset of the Calendar API the bot uses."""
+
+    def __init__(self, events=(), faults: Faults | None = None):
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        self.events = {}
+        # Sync tokens are sequence numbers; event id -> seq of its last change.
+        self._seq = 0
+        self._changed = {}
+        for event in events:
+            self._store(dict(event))
+
+    def _store(self, event: dict) -> dict:
+        self._seq += 1
+        event["updated"] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        event["etag"] = f'"{self._seq}"'
+        self.events[event["id"]] = event
+        self._changed[event["id"]] = self._seq
+        return event
+
+    # Direct mutations used by benchmarks to simulate edits made elsewhere.
+
+    def move(self, event_id: str, minutes: int) -> None:
+        with self.lock:
+            event = dict(self.events[event_id])
+            for field in ("start", "end"):
+                moved = datetime.fromisoformat(event[field]["dateTime"]) + timedelta(minutes=minutes)
+                event[field] = {**event[field], "dateTime": moved.isoformat()}
+            self._store(event)
+
+    def cancel(self, event_id: str) -> None:
+        with self.lock:
+            event = dict(self.events[event_id], status="cancelled")
+            self._store(event)
+
+    # Service surface
+
+    def events_resource(self):
+        return SimpleNamespace(
+            list=lambda **p: FakeRequest(self, self._list, "calendar.events.list", **p),
+            get=lambda **p: FakeRequest(self, self._get, "calendar.events.get", **p),
+            insert=lambda **p: FakeRequest(self, self._insert, "calendar.events.insert", **p),
+            patch=lambda **p: FakeRequest(self, self._patch, "calendar.events.patch", **p),
+            update=lambda **p: FakeRequest(self, self._patch, "calendar.events.update", **p),
+            delete=lambda **p: FakeRequest(self, self._delete, "calendar.events.delete", **p),
+            watch=lambda **p: FakeRequest(self, self._watch, "calendar.events.watch", **p),
+        )
+
+    def service(self):
+        return SimpleNamespace(
+            events=self.events_resource,
+            calendarList=lambda: SimpleNamespace(
+                list=lambda **p: FakeRequest(
+                    self, self._calendar_list, "calendar.calendarList.list", **p
+                )
+            ),
+            channels=lambda: SimpleNamespace(
+                stop=lambda **p: FakeRequest(self, lambda **_: "", "calendar.channels.stop", **p)
+            ),
+            new_batch_http_request=lambda callback=None: FakeBatch(self, callback),
+        )
+
+    def _live(self, event) -> bool:
+        return event.get("status") != "cancelled"
+
+    def _list(self, headers, calendarId="primary", timeMin=None, timeMax=None,
+              syncToken=None, pageToken=None, maxResults=250, orderBy=None, **_):
+        if syncToken is not None:
+            since = int(syncToken)
+            items = [
+                self.events[event_id]
+                for event_id, seq in self._changed.items()
+                if seq > since
+            ]
+        else:
+            lo = _parse_rfc3339(timeMin) if timeMin else float("-inf")
+            hi = _parse_rfc3339(timeMax) if timeMax else float("inf")
+            items = []
+            for event in self.events.values():
+                if not self._live(event):
+                    continue
+                start, end = event_bounds(event)
+                if end > lo and start < hi:
+                    items.append(event)
+            if orderBy == "startTime":
+                items.sort(key=lambda e: event_bounds(e)[0])
+        offset = int(pageToken or 0)
+        page = items[offset:offset + maxResults]
+        result = {"items": [dict(e) for e in page]}
+        if offset + maxResults < len(items):
+            result["nextPageToken"] = str(offset + maxResults)
+        else:
+            result["nextSyncToken"] = str(self._seq)
+        return result
+
+    def _get(self, headers, eventId, **_):
+        event = self.events.get(eventId)
+        if event is None or not self._live(event):
+            raise _http_error(404)
+        return dict(event)
+
+    def _insert(self, headers, body, **_):
+        event = dict(body, id=uuid.uuid4().hex, status="confirmed")
+        return dict(self._store(event))
+
+    def _patch(self, headers, eventId, body, **_):
+        current = self.events.get(eventId)
+        if current is None or not self._live(current):
+            raise _http_error(404)
+        if headers.get("If-Match") and headers["If-Match"] != current["etag"]:
+            raise _http_error(412)
+        return dict(self._store({**current, **body}))
+
+    def _delete(self, headers, eventId, **_):
+        if eventId not in self.events:
+            raise _http_error(404)
+        self._store(dict(self.events[eventId], status="cancelled"))
+        return ""
+
+    def _watch(self, headers, body, **_):
+        return {"resourceId": uuid.uuid4().hex, "expiration": str(int((time.time() + 86400) * 1000))}
+
+    def _calendar_list(self, headers, **_):
+        return {"items": [{"id": "primary", "summary": "ראשי", "primary": True}]}
+
+
+class FakePushNotifier:
+    """Posts Calendar push notifications the way Google does.
+
+    ``client`` is anything with an aiohttp-style ``post(path, ...)``, e.g.
+    an ``aiohttp.test_utils.TestClient`` around the bot's web app.
+    """
+
+    def __init__(self, client, path: str, token: str):
+        self._client = client
+        self._path = path
+        self._token = token
+        self._numbers = {}
+
+    async def notify(self, channel_id: str, resource_id: str, state: str = "exists", token=None) -> int:
+        """Send one notification and return the HTTP status."""
+        number = self._numbers[channel_id] = self._numbers.get(channel_id, 0) + 1
+        headers = {
+            "X-Goog-Channel-ID": channel_id,
+            "X-Goog-Channel-Token": self._token if token is None else token,
+            "X-Goog-Resource-ID": resource_id,
+            "X-Goog-Resource-State": state,
+            "X-Goog-Resource-URI": "https://www.googleapis.com/calendar/v3/calendars/primary/events",
+            "X-Goog-Message-Number": str(number),
+        }
+        response = await self._client.post(self._path, headers=headers)
+        return response.status
+
+
+# Anthropic
+
+
+class FakeMessages:
+    """``messages.create`` / ``messages.stream`` answering like the real prompts."""
+
+    def __init__(self, faults: Faults, tokens_per_second: float = 0.0):
+        self.faults = faults
+        self.tokens_per_second = tokens_per_second
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def _answer(self, messages) -> str:
+        content = messages[-1]["content"]
+        if content.startswith("[תאריך]"):
+            lines = [line for line in content.split("\n")[1:] if line.strip()]
+            return "לו\"ז 📅:\n" + "\n".join(f"- {line}" for line in lines)
+        # Intent prompt: "... הפקודה היא: <text>"
+        text = content.split("הפקודה היא:", 1)[-1].strip()
+        today = datetime.now(LOCAL_TZ).date()
+        data, _ = parse_intent(text.split("\n")[0], today)
+        return json.dumps(data or {"action": "summarize", "date": today.isoformat()}, ensure_ascii=False)
+
+    async def _wait(self, text: str) -> None:
+        await asyncio.sleep(self.faults.delay())
+        if self.faults.should_fail():
+            raise asyncio.TimeoutError("injected LLM failure")
+
+    def _usage(self, kwargs, text):
+        system = kwargs.get("system") or ""
+        if isinstance(system, list):
+            system = "".join(block["text"] for block in system)
+        prompt = system + "".join(m["content"] for m in kwargs["messages"])
+        usage = SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4)
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        return usage
+
+    async def create(self, **kwargs):
+        text = self._answer(kwargs["messages"])
+        await self._wait(text)
+        if self.tokens_per_second:
+            await asyncio.sleep(len(text) / 4 / self.tokens_per_second)
+        return SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=text)], usage=self._usage(kwargs, text)
+        )
+
+    def stream(self, **kwargs):
+        return _FakeStream(self, kwargs)
+
+
+class _FakeStream:
+    def __init__(self, messages: FakeMessages, kwargs):
+        self._messages = messages
+        self._kwargs = kwargs
+
+    async def __aenter__(self):
+        self._text = self._messages._answer(self._kwargs["messages"])
+        await self._messages._wait(self._text)
+        self._usage = self._messages._usage(self._kwargs, self._text)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        step = 16
+        for i in range(0, len(self._text), step):
+            if self._messages.tokens_per_second:
+                await asyncio.sleep(step / 4 / self._messages.tokens_per_second)
+            yield self._text[i:i + step]
+
+    async def get_final_message(self):
+        return SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=self._text)], usage=self._usage
+        )
+
+
+class FakeAnthropic:
+    def __init__(self, faults: Faults | None = None, tokens_per_second: float = 0.0):
+        self.messages = FakeMessages(faults or Faults(), tokens_per_second)
+
+
+# Telegram
+
+
+class FakeBot:
+    """Records every outgoing message; ``send_message`` honours the faults."""
+
+    def __init__(self, faults: Faults | None = None):
+        self.faults = faults or Faults()
+        self.sent = []
+        self.edits = 0
+
+    async def send_message(self, chat_id, text, **_):
+        await asyncio.sleep(self.faults.delay())
+        if self.faults.should_fail():
+            raise NetworkError("injected send failure")
+        self.sent.append((chat_id, text))
+        return FakeMessage(self, chat_id, text)
+
+
+class FakeTelegramPoster:
+    """Posts updates to the webhook the way Telegram does.
+
+    ``client`` is anything with an aiohttp-style ``post(path, ...)``.
+    """
+
+    def __init__(self, client, path: str, secret: str):
+        self._client = client
+        self._path = path
+        self._secret = secret
+        self._update_id = 0
+
+    def message(self, user_id: int, text: str) -> dict:
+        """A new text message from ``user_id`` in their private chat."""
+        self._update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": "Test"}
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": text,
+            },
+        }
+
+    async def post(self, body, secret=None) -> int:
+        """Send ``body`` (a dict, or raw bytes as-is) and return the HTTP status."""
+        headers = {
+            "X-Telegram-Bot-Api-Secret-Token": self._secret if secret is None else secret,
+            "Content-Type": "application/json",
+        }
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        response = await self._client.post(self._path, data=data, headers=headers)
+        return response.status
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, text: str = ""):
+        self._bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **_):
+        self.replies.append(text)
+        return await self._bot.send_message(self.chat_id, text)
+
+    async def edit_text(self, text, **_):
+        await asyncio.sleep(self._bot.faults.delay())
+        self._bot.edits += 1
+        self.text = text
+        return self
+
+
+def make_update(bot: FakeBot, user_id: int, text: str):
+    message = FakeMessage(bot, user_id, text)
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=message,
+        effective_message=message,
+    )
+
+
+def make_context(bot: FakeBot, bot_data: dict, user_data: dict | None = None, args=None):
+    return SimpleNamespace(bot=bot, bot_data=bot_data, user_data=user_data or {}, args=args or [])
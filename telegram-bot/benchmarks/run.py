@@ -0,0 +1,296 @@
+"""Offline benchmarks for the message, summary and poll paths.
+
+Run from the telegram-bot directory::
+
+    python -m benchmarks.run --events 10 100 1000 10000 --users 20
+
+Telegram, Anthropic and Google Calendar are replaced by the fakes in
+``benchmarks/fakes.py``; ``--*-latency`` and ``--error-rate`` shape them and
+``--seed`` makes runs repeatable. Each row reports throughput, p50/p95/p99
+latency, the ops that failed and the peak memory allocated during the
+scenario (tracemalloc).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# Configure the bot before its modules read the environment.
+_tmp = tempfile.mkdtemp(prefix="xo-bench-")
+os.environ.setdefault("STATE_DB_PATH", os.path.join(_tmp, "state.db"))
+os.environ.setdefault("POLL_INTERVAL", "3600")
+os.environ.setdefault("POLL_JITTER", "0")
+os.environ.setdefault("CALENDAR_BACKOFF", "0.01")
+os.environ.setdefault("OUTBOX_RETRY_BACKOFF", "0.01")
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "100000")
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "100000")
+os.environ.setdefault("TELEGRAM_CHAT_BURST", "100000")
+os.environ.setdefault("STREAM_EDIT_INTERVAL", "0")
+
+from google.oauth2.credentials import Credentials  # noqa: E402
+
+import create_event  # noqa: E402
+import event_cache  # noqa: E402
+import event_watcher  # noqa: E402
+import llm_client  # noqa: E402
+import telegram_bot  # noqa: E402
+from benchmarks.fakes import (  # noqa: E402
+    FakeAnthropic,
+    FakeBot,
+    FakeCalendar,
+    Faults,
+    TITLES,
+    make_context,
+    make_events,
+    make_update,
+)
+from event_cache import LOCAL_TZ  # noqa: E402
+from telegram.error import NetworkError  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from request_queue import RequestQueue  # noqa: E402
+from state_store import get_store  # noqa: E402
+
+
+# Replies the handlers send when a command failed.
+ERROR_REPLIES = ("❌ שגיאה", "⌛", "🔑")
+
+
+def answered_with_error(update) -> bool:
+    return any(reply.startswith(ERROR_REPLIES) for reply in update.message.replies)
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Bench:
+    """Synthetic users, each with their own fake calendar."""
+
+    def __init__(self, args, events_per_user: int, span: timedelta, start: datetime):
+        self.args = args
+        self.seed = args.seed
+        self.bot = FakeBot(Faults(args.telegram_latency, args.telegram_latency / 2, args.error_rate, args.seed))
+        llm_client.ai_client = FakeAnthropic(
+            Faults(args.llm_latency, args.llm_latency / 2, args.error_rate, args.seed + 1),
+            tokens_per_second=args.llm_tokens_per_second,
+        )
+        self.bot_data = {}
+        self.calendars = {}
+        store = get_store()
+        calendar_faults = Faults(
+            args.calendar_latency, args.calendar_latency / 2, args.error_rate, args.seed + 2
+        )
+        event_cache._caches.clear()
+        for user_id in range(1, args.users + 1):
+            store.add_approved_user(user_id)
+            store.set_calendar_id(user_id, "primary")
+            store.set_chat_id(user_id, user_id)
+            calendar = FakeCalendar(
+                make_events(events_per_user, start, span, seed=args.seed + user_id),
+                calendar_faults,
+            )
+            self.calendars[user_id] = calendar
+            # Served from the service cache, as after a real OAuth flow.
+            create_event._cache_service(user_id, Credentials(token="bench"), calendar.service())
+
+    def context(self, user_data=None):
+        return make_context(self.bot, self.bot_data, user_data)
+
+
+def report(
+    name: str, events: int, latencies: list, elapsed: float, peak: int,
+    ops: int | None = None, failed: int = 0,
+) -> dict:
+    ops = len(latencies) if ops is None else ops
+    row = {
+        "scenario": name,
+        "events": events,
+        "ops": ops,
+        "failed": failed,
+        "throughput": ops / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_mb": peak / 2**20,
+    }
+    print(
+        f"{name:<16} {events:>7} {ops:>6} {failed:>6} {row['throughput']:>10.1f} "
+        f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['peak_mb']:>8.1f}",
+        flush=True,
+    )
+    return row
+
+
+async def bench_messages(args, events: int) -> dict:
+    """``handle_message`` end to end: queue, parsing, Calendar mutation, reply."""
+    now = datetime.now(timezone.utc)
+    bench = Bench(args, events, timedelta(days=7), now)
+    tomorrow = (now.astimezone(LOCAL_TZ) + timedelta(days=1)).strftime("%d/%m")
+    commands = [
+        "סכם את מחר",
+        f"קבע {TITLES[0]} ב-{tomorrow} בשעה 10:00",
+        f"מחק {TITLES[1]}",
+        f"הזז {TITLES[2]} ל-{tomorrow} בשעה 12:00",
+        f"קבע {TITLES[3]} מחר בשעה 09:00 וגם תזכיר לי",
+    ]
+    submitted, done, failed = {}, {}, set()
+
+    async def timed(update, context, text, coalesced):
+        # Injected faults can escape the handler (e.g. a failed error reply);
+        # the op still finishes, as a failure.
+        try:
+            await telegram_bot.process_message(update, context, text, coalesced)
+            if answered_with_error(update):
+                failed.add(id(update))
+        except Exception:
+            failed.add(id(update))
+            raise
+        finally:
+            done[id(update)] = time.perf_counter()
+
+    queue = RequestQueue(timed, telegram_bot.can_coalesce)
+    bench.bot_data["request_queue"] = queue
+    queue.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    for round_ in range(args.rounds):
+        for user_id in bench.calendars:
+            text = commands[(user_id + round_) % len(commands)]
+            update = make_update(bench.bot, user_id, text)
+            submitted[id(update)] = time.perf_counter()
+            try:
+                await telegram_bot.handle_message(update, bench.context())
+            except NetworkError:
+                # The "processing" reply failed before the message was queued.
+                failed.add(id(update))
+                done[id(update)] = time.perf_counter()
+        while len(done) < len(submitted):
+            await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    await queue.stop()
+    latencies = [done[key] - submitted[key] for key in submitted]
+    return report("message", events, latencies, elapsed, peak, failed=len(failed))
+
+
+async def bench_summary(args, events: int, mode: str) -> dict:
+    """``send_schedule_for_date`` for a day holding all of the user's events."""
+    day = datetime.now(LOCAL_TZ).date() + timedelta(days=1)
+    start = datetime(day.year, day.month, day.day, tzinfo=LOCAL_TZ)
+    bench = Bench(args, events, timedelta(days=1), start)
+    store = get_store()
+    for user_id in bench.calendars:
+        store.set_summary_mode(user_id, mode)
+    latencies = []
+    failed = 0
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for user_id, calendar in bench.calendars.items():
+            update = make_update(bench.bot, user_id, "סכם את מחר")
+            t0 = time.perf_counter()
+            try:
+                await telegram_bot.send_schedule_for_date(
+                    update, bench.context(), calendar.service(), "primary", day
+                )
+                failed += answered_with_error(update)
+            except NetworkError:
+                # The handler's own error reply hit an injected send failure.
+                failed += 1
+            latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    return report(f"summary-{mode}", events, latencies, elapsed, peak, failed=failed)
+
+
+async def bench_poll(args, events: int) -> list:
+    """``check_event_changes`` ticks; after the first, 1% of events change."""
+    now = datetime.now(timezone.utc)
+    bench = Bench(args, events, timedelta(hours=23), now + timedelta(minutes=5))
+    outbox = Outbox(bench.bot)
+    bench.bot_data["outbox"] = outbox
+    outbox.start()
+    event_watcher._poll_locks.clear()
+    ticks = []
+    tracemalloc.reset_peak()
+    for tick in range(args.rounds + 1):
+        if tick:
+            for calendar in bench.calendars.values():
+                ids = sorted(calendar.events)[: max(1, events // 100)]
+                for i, event_id in enumerate(ids):
+                    if calendar.events[event_id].get("status") == "cancelled":
+                        continue
+                    if i % 2:
+                        calendar.cancel(event_id)
+                    else:
+                        calendar.move(event_id, 30)
+        t0 = time.perf_counter()
+        await event_watcher.check_event_changes(bench.context())
+        ticks.append(time.perf_counter() - t0)
+    _, peak = tracemalloc.get_traced_memory()
+    await outbox.stop()
+    # Report the steady-state ticks; the first one is the initial full sync.
+    row = report("poll-initial", events, ticks[:1], ticks[0], peak, ops=len(bench.calendars))
+    rows = [row]
+    if len(ticks) > 1:
+        steady = ticks[1:]
+        rows.append(
+            report("poll-steady", events, steady, sum(steady), peak, ops=len(bench.calendars) * len(steady))
+        )
+    rows[-1]["alerts"] = len(bench.bot.sent)
+    return rows
+
+
+async def main(args) -> list:
+    tracemalloc.start()
+    print(
+        f"{'scenario':<16} {'events':>7} {'ops':>6} {'failed':>6} {'ops/s':>10} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8}"
+    )
+    rows = []
+    for events in args.events:
+        if "message" in args.scenarios:
+            rows.append(await bench_messages(args, events))
+        if "summary" in args.scenarios:
+            rows.append(await bench_summary(args, events, "local"))
+            rows.append(await bench_summary(args, events, "rich"))
+        if "poll" in args.scenarios:
+            rows.extend(await bench_poll(args, events))
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="events per synthetic calendar")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--scenarios", nargs="+", default=["message", "summary", "poll"],
+                        choices=["message", "summary", "poll"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--calendar-latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of fake calls that fail")
+    parser.add_argument("--json", help="also write the rows to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    results = asyncio.run(main(arguments))
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0)
@@ -0,0 +1,143 @@
+import os
+import asyncio
+import random
+import itertools
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from metrics import CALENDAR_CALLS, CALENDAR_ERRORS, log, span
+
+# All blocking googleapiclient work runs on this shared pool so the asyncio
+# loop never waits on Google.
+CALENDAR_WORKERS = int(os.getenv("CALENDAR_WORKERS", 16))
+CALENDAR_TIMEOUT = float(os.getenv("CALENDAR_TIMEOUT", 20))
+CALENDAR_RETRIES = int(os.getenv("CALENDAR_RETRIES", 3))
+CALENDAR_BACKOFF = float(os.getenv("CALENDAR_BACKOFF", 0.5))
+
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+_executor = ThreadPoolExecutor(
+    max_workers=CALENDAR_WORKERS, thread_name_prefix="calendar"
+)
+_user_locks: dict = {}
+_request_class = None
+
+
+def request_builder():
+    """``requestBuilder`` for Calendar services that counts every API request.
+
+    Calls and errors are labelled with Google's method ID, e.g.
+    "calendar.events.list". Built on first use, since importing
+    googleapiclient.http is slow.
+    """
+    global _request_class
+    if _request_class is None:
+        from googleapiclient.http import HttpRequest
+
+        class CountedHttpRequest(HttpRequest):
+            def execute(self, http=None, num_retries=0):
+                CALENDAR_CALLS.inc(method=self.methodId)
+                try:
+                    return super().execute(http=http, num_retries=num_retries)
+                except HttpError as e:
+                    CALENDAR_ERRORS.inc(method=self.methodId, status=e.resp.status)
+                    raise
+
+        _request_class = CountedHttpRequest
+    return _request_class
+
+
+def count_batched(request, error=None) -> None:
+    """Count a request sent inside a batch; it never runs its own ``execute``."""
+    method = getattr(request, "methodId", None) or "batch"
+    CALENDAR_CALLS.inc(method=method)
+    if isinstance(error, HttpError):
+        CALENDAR_ERRORS.inc(method=method, status=error.resp.status)
+
+
+def _user_lock(user_id) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+def _is_retryable(error: HttpError, retry_server_errors: bool) -> bool:
+    status = error.resp.status
+    if status == 429:
+        return True
+    if status == 403:
+        content = error.content or b""
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", "ignore")
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return retry_server_errors and 500 <= status < 600
+
+
+def _backoff(attempt: int) -> float:
+    return CALENDAR_BACKOFF * (2 ** attempt) + random.uniform(0, CALENDAR_BACKOFF)
+
+
+def _release_when_done(future, lock: asyncio.Lock) -> None:
+    if not future.cancelled():
+        future.exception()  # mark as retrieved; the caller already gave up
+    lock.release()
+
+
+async def run(
+    user_id,
+    func,
+    *args,
+    retry_server_errors: bool = True,
+    method: str | None = None,
+    stage: str = "calendar",
+    **kwargs,
+):
+    """Run a blocking Calendar call on the worker pool.
+
+    Calls for the same ``user_id`` run one at a time in arrival order. Each
+    attempt is bounded by ``CALENDAR_TIMEOUT`` and 429 / rate-limit 403 /
+    5xx responses are retried with jittered exponential backoff. Pass
+    ``retry_server_errors=False`` for non-idempotent calls such as inserts.
+    ``method`` names the call in retry logs (default: the function's
+    name) and ``stage`` is the timing span it counts towards. API calls
+    themselves are counted per HTTP request, see :func:`request_builder`.
+    """
+    loop = asyncio.get_running_loop()
+    call = partial(func, *args, **kwargs)
+    method = method or getattr(func, "__name__", "call")
+    lock = _user_lock(user_id)
+    await lock.acquire()
+    pending = None
+    try:
+        for attempt in itertools.count():
+            pending = loop.run_in_executor(_executor, call)
+            try:
+                with span(stage):
+                    return await asyncio.wait_for(
+                        asyncio.shield(pending), timeout=CALENDAR_TIMEOUT
+                    )
+            except HttpError as e:
+                pending = None
+                if attempt >= CALENDAR_RETRIES or not _is_retryable(
+                    e, retry_server_errors
+                ):
+                    raise
+                log("calendar_retry", method=method, status=e.resp.status, attempt=attempt + 1)
+                await asyncio.sleep(_backoff(attempt))
+    finally:
+        if pending is not None and not pending.done():
+            # The worker thread is still talking to Google (timeout or
+            # cancellation); keep this user's queue closed until it returns so
+            # the next call cannot race it on the same service object.
+            pending.add_done_callback(partial(_release_when_done, lock=lock))
+        else:
+            lock.release()
+
+
+async def execute(user_id, request, **kwargs):
+    """Execute a prepared googleapiclient request via :func:`run`."""
+    kwargs.setdefault("method", getattr(request, "methodId", None))
+    return await run(user_id, request.execute, **kwargs)
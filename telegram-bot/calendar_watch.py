@@ -0,0 +1,195 @@
+import os
+import hmac
+import time
+import uuid
+import asyncio
+import secrets
+import traceback
+
+import aiohttp.web as web
+from telegram.ext import ContextTypes
+
+import calendar_gateway
+from create_event import authenticate_google_calendar, load_user_calendar_id
+from event_watcher import polls_user, refresh_user
+from metrics import log
+from state_store import get_store
+
+# Public https base URL Google can reach, e.g. https://bot.example.com.
+# Push notifications are disabled when it is not set.
+# With several instances, give each its own directly reachable URL: a
+# channel is only known to the instance that polls its user. Channels are
+# kept in the state store under this URL, so they survive restarts.
+CALENDAR_WEBHOOK_URL = os.getenv("CALENDAR_WEBHOOK_URL", "").rstrip("/")
+# Sent with new channels; every channel is stored with its own token, so a
+# random token per start still works for channels made before a restart.
+CALENDAR_WEBHOOK_TOKEN = os.getenv("CALENDAR_WEBHOOK_TOKEN") or secrets.token_urlsafe(24)
+CHANNEL_TTL = int(os.getenv("CHANNEL_TTL", 7 * 24 * 3600))
+CHANNEL_RENEW_MARGIN = int(os.getenv("CHANNEL_RENEW_MARGIN", 3600))
+CHANNEL_CHECK_INTERVAL = int(os.getenv("CHANNEL_CHECK_INTERVAL", 600))
+# Notifications for the same user within this window trigger a single diff.
+PUSH_DEBOUNCE = float(os.getenv("PUSH_DEBOUNCE", 1.0))
+
+NOTIFY_PATH = "/calendar/notify"
+
+
+def push_enabled() -> bool:
+    return bool(CALENDAR_WEBHOOK_URL)
+
+
+def _channels(bot_data: dict) -> dict:
+    """channel_id -> {user_id, calendar_id, resource_id, expiration, token}.
+
+    Loaded from the store on first use.
+    """
+    channels = bot_data.get("watch_channels")
+    if channels is None:
+        channels = bot_data["watch_channels"] = get_store().load_channels(CALENDAR_WEBHOOK_URL)
+        user_channels = bot_data["user_channels"] = {}
+        # The latest channel of a user is their live one.
+        for channel_id, channel in sorted(channels.items(), key=lambda c: c[1]["expiration"]):
+            user_channels[channel["user_id"]] = channel_id
+    return channels
+
+
+def _user_channels(bot_data: dict) -> dict:
+    """user_id -> channel_id of the user's live channel."""
+    _channels(bot_data)
+    return bot_data["user_channels"]
+
+
+def _add_channel(bot_data: dict, channel_id: str, channel: dict) -> None:
+    _channels(bot_data)[channel_id] = channel
+    _user_channels(bot_data)[channel["user_id"]] = channel_id
+    get_store().save_channel(channel_id, CALENDAR_WEBHOOK_URL, channel)
+
+
+def _forget_channel(bot_data: dict, channel_id: str) -> None:
+    _channels(bot_data).pop(channel_id, None)
+    get_store().delete_channel(channel_id)
+
+
+def _forget_user_channel(bot_data: dict, user_id: int) -> None:
+    channel_id = _user_channels(bot_data).pop(user_id, None)
+    if channel_id is not None:
+        _forget_channel(bot_data, channel_id)
+
+
+async def _stop_channel(user_id: int, service, channel: dict, channel_id: str) -> None:
+    try:
+        await calendar_gateway.execute(
+            user_id,
+            service.channels().stop(
+                body={"id": channel_id, "resourceId": channel["resource_id"]}
+            ),
+        )
+    except Exception as e:
+        # The channel expires on its own; a failed stop only costs a few
+        # ignored notifications.
+        log("channel_stop_failed", channel_id=channel_id, error=repr(e))
+
+
+async def ensure_channel(bot_data: dict, user_id: int, service, calendar_id: str) -> None:
+    """Make sure ``user_id`` has a live watch channel on ``calendar_id``.
+
+    A channel is replaced when the user switched calendars or it expires
+    within ``CHANNEL_RENEW_MARGIN`` seconds.
+    """
+    channels = _channels(bot_data)
+    user_channels = _user_channels(bot_data)
+    current_id = user_channels.get(user_id)
+    current = channels.get(current_id) if current_id else None
+    if (
+        current
+        and current["calendar_id"] == calendar_id
+        and current["expiration"] - time.time() > CHANNEL_RENEW_MARGIN
+    ):
+        return
+
+    channel_id = str(uuid.uuid4())
+    response = await calendar_gateway.execute(
+        user_id,
+        service.events().watch(
+            calendarId=calendar_id,
+            body={
+                "id": channel_id,
+                "type": "web_hook",
+                "address": CALENDAR_WEBHOOK_URL + NOTIFY_PATH,
+                "token": CALENDAR_WEBHOOK_TOKEN,
+                "params": {"ttl": str(CHANNEL_TTL)},
+            },
+        ),
+    )
+    expiration_ms = int(response.get("expiration") or (time.time() + CHANNEL_TTL) * 1000)
+    _add_channel(bot_data, channel_id, {
+        "user_id": user_id,
+        "calendar_id": calendar_id,
+        "resource_id": response.get("resourceId"),
+        "expiration": expiration_ms / 1000,
+        "token": CALENDAR_WEBHOOK_TOKEN,
+    })
+
+    if current:
+        _forget_channel(bot_data, current_id)
+        await _stop_channel(user_id, service, current, current_id)
+
+
+async def renew_channels(context: ContextTypes.DEFAULT_TYPE):
+    """Register missing channels and renew the ones about to expire."""
+    bot_data = context.bot_data
+    for user_id in get_store().approved_users():
+        if not polls_user(bot_data, user_id):
+            # Another instance polls this user and owns their channel.
+            _forget_user_channel(bot_data, user_id)
+            continue
+        try:
+            service = await calendar_gateway.run(
+                user_id, authenticate_google_calendar, user_id, stage="credentials"
+            )
+            calendar_id = load_user_calendar_id(user_id) if service else None
+            if not calendar_id:
+                # Without a calendar there is nothing to watch; fall back to
+                # plain polling for this user.
+                _forget_user_channel(bot_data, user_id)
+                continue
+            await ensure_channel(bot_data, user_id, service, calendar_id)
+        except Exception as e:
+            log("channel_renew_failed", user_id=user_id, error=repr(e))
+            traceback.print_exc()
+
+
+async def _debounced_refresh(ptb_app, user_id: int) -> None:
+    pending = ptb_app.bot_data.setdefault("push_pending", set())
+    await asyncio.sleep(PUSH_DEBOUNCE)
+    pending.discard(user_id)
+    await refresh_user(ptb_app.bot_data, user_id)
+
+
+async def calendar_notify(request: web.Request) -> web.Response:
+    """Receive Google Calendar push notifications.
+
+    ``sync`` messages only confirm a new channel. ``exists`` and
+    ``not_exists`` mean something changed, so the owner's calendar is
+    diffed right away instead of waiting for the next poll tick.
+    """
+    headers = request.headers
+    channel_id = headers.get("X-Goog-Channel-ID")
+    state = headers.get("X-Goog-Resource-State")
+
+    ptb_app = request.app["ptb_app"]
+    channel = _channels(ptb_app.bot_data).get(channel_id)
+    if not channel or channel["resource_id"] != headers.get("X-Goog-Resource-ID"):
+        # Unknown or replaced channel; acknowledge so Google stops retrying.
+        return web.Response(status=200)
+    token = headers.get("X-Goog-Channel-Token", "")
+    if not hmac.compare_digest(token.encode(), (channel.get("token") or "").encode()):
+        return web.Response(status=403)
+
+    if state in ("exists", "not_exists"):
+        user_id = channel["user_id"]
+        pending = ptb_app.bot_data.setdefault("push_pending", set())
+        if user_id not in pending:
+            pending.add(user_id)
+            ptb_app.create_task(_debounced_refresh(ptb_app, user_id))
+
+    return web.Response(status=200)
@@ -1,16 +1,22 @@
 from datetime import datetime, timedelta
 import os
 import json
+import secrets
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow, Flow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
 from google.auth.exceptions import RefreshError
-from dotenv import load_dotenv
 
-load_dotenv()
+import calendar_gateway
+from metrics import log
+from state_store import get_store
+
+# googleapiclient.discovery, google.auth.transport.requests and
+# google_auth_oauthlib are imported where they are used: building the first
+# service, refreshing a token and the OAuth flow. Startup pre-warming pays
+# for them off the event loop.
 
 BASE_DIR = Path(__file__).resolve().parent
 CREDENTIALS_FILE = Path(
@@ -19,8 +25,21 @@ CREDENTIALS_FILE = Path(
 
 # Define Google Calendar Access Scope
 SCOPES = ['https://www.googleapis.com/auth/calendar']
-TOKEN_DIR = BASE_DIR / "tokens"
-CALENDAR_PREF_PREFIX = "calendar_"
+LEGACY_TOKEN_FILE = BASE_DIR / "token.json"
+
+# Built services are kept per user so discovery and token loading happen once
+# per user instead of once per message/poll.
+SERVICE_CACHE_SIZE = int(os.getenv("SERVICE_CACHE_SIZE", 256))
+# Refresh access tokens this long before they expire so the refresh never
+# lands on the first API call of a request.
+TOKEN_REFRESH_MARGIN = timedelta(seconds=int(os.getenv("TOKEN_REFRESH_MARGIN", 300)))
+
+# Google accepts at most 50 calls in one batch request.
+BATCH_LIMIT = 50
+
+_service_cache: "OrderedDict[int | None, tuple]" = OrderedDict()
+_service_cache_lock = threading.Lock()
+_discovery_doc = None
 
 
 def _load_credentials_config() -> dict:
@@ -48,91 +67,190 @@ def _resolve_redirect_uri() -> str | None:
     return None
 
 
+def _calendar_discovery_doc() -> dict:
+    """Return the Calendar v3 discovery document bundled with googleapiclient.
+
+    Parsed once per process; building a service from it never hits the
+    network.
+    """
+    global _discovery_doc
+    if _discovery_doc is None:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        _discovery_doc = json.loads(get_static_doc("calendar", "v3"))
+    return _discovery_doc
+
+
+def _build_service(creds: Credentials):
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(
+        _calendar_discovery_doc(),
+        credentials=creds,
+        requestBuilder=calendar_gateway.request_builder(),
+    )
+
+
+def _load_token(user_id: int | None) -> str | None:
+    """Return the stored token JSON; ``None`` selects the legacy token.json."""
+    if user_id is not None:
+        return get_store().get_token(user_id)
+    if LEGACY_TOKEN_FILE.exists():
+        return LEGACY_TOKEN_FILE.read_text()
+    return None
+
+
+def _save_token(user_id: int | None, token: str | None) -> None:
+    if user_id is not None:
+        get_store().set_token(user_id, token)
+    elif token is None:
+        try:
+            LEGACY_TOKEN_FILE.unlink()
+        except OSError:
+            pass
+    else:
+        LEGACY_TOKEN_FILE.write_text(token)
+
+
+def _needs_refresh(creds: Credentials) -> bool:
+    if creds.expired:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth keeps ``expiry`` as a naive UTC datetime.
+    return creds.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN
+
+
+def _cache_service(user_id: int | None, creds: Credentials, service) -> None:
+    with _service_cache_lock:
+        _service_cache[user_id] = (creds, service)
+        _service_cache.move_to_end(user_id)
+        while len(_service_cache) > SERVICE_CACHE_SIZE:
+            _service_cache.popitem(last=False)
+
+
+def invalidate_user_service(user_id: int | None) -> None:
+    """Drop the cached service for ``user_id`` (e.g. after a RefreshError)."""
+    with _service_cache_lock:
+        _service_cache.pop(user_id, None)
+
+
+def _refresh_or_forget(user_id: int | None, creds: Credentials) -> bool:
+    """Refresh ``creds`` and persist them; forget the user on RefreshError."""
+    from google.auth.transport.requests import Request
+
+    try:
+        creds.refresh(Request())
+    except RefreshError:
+        # Stored credentials are no longer valid; remove the token so a
+        # new OAuth flow can be initiated.
+        invalidate_user_service(user_id)
+        _save_token(user_id, None)
+        return False
+    _save_token(user_id, creds.to_json())
+    return True
+
+
 def authenticate_google_calendar(user_id: int | None = None):
     """Return an authenticated Google Calendar service for the given user.
 
     If ``user_id`` is ``None`` the legacy single-user token is used.
-    Otherwise the token is loaded from ``tokens/token_<user_id>.json``.
+    Otherwise the token is loaded from the state store.
     When no token is found ``None`` is returned.
+
+    Services are cached per user (LRU, ``SERVICE_CACHE_SIZE`` entries) and
+    tokens are refreshed ``TOKEN_REFRESH_MARGIN`` before they expire.
     """
-    if user_id is None:
-        token_path = BASE_DIR / "token.json"
-    else:
-        TOKEN_DIR.mkdir(exist_ok=True)
-        token_path = TOKEN_DIR / f"token_{user_id}.json"
+    with _service_cache_lock:
+        entry = _service_cache.get(user_id)
+        if entry:
+            _service_cache.move_to_end(user_id)
+
+    if entry:
+        creds, service = entry
+        if _needs_refresh(creds):
+            if creds.refresh_token:
+                if not _refresh_or_forget(user_id, creds):
+                    return None
+            elif creds.expired:
+                invalidate_user_service(user_id)
+                return None
+        return service
 
     creds = None
-    if token_path.exists():
-        creds = Credentials.from_authorized_user_file(str(token_path), SCOPES)
-        if creds:
-            if creds.expired and creds.refresh_token:
-                try:
-                    creds.refresh(Request())
-                except RefreshError:
-                    # Stored credentials are no longer valid; remove the token so a
-                    # new OAuth flow can be initiated.
-                    try:
-                        token_path.unlink()
-                    except OSError:
-                        pass
+    token = _load_token(user_id)
+    if token:
+        creds = Credentials.from_authorized_user_info(json.loads(token), SCOPES)
+        if creds and _needs_refresh(creds):
+            if creds.refresh_token:
+                if not _refresh_or_forget(user_id, creds):
                     return None
-            elif creds.expired and not creds.refresh_token:
+            elif creds.expired:
                 # Cannot refresh without a refresh token; force re-authentication.
                 return None
 
     if not creds:
         return None
 
-    return build('calendar', 'v3', credentials=creds)
+    service = _build_service(creds)
+    _cache_service(user_id, creds, service)
+    return service
 
 
 def start_auth_flow(user_id: int):
-    """Create a web OAuth flow and return (auth_url, flow)."""
+    """Create a web OAuth flow and return (auth_url, flow_state).
+
+    ``flow_state`` is a JSON-serializable dict, so the callback can be
+    completed by any instance that shares the state store.
+    """
+    from google_auth_oauthlib.flow import Flow
+
     redirect_uri = _resolve_redirect_uri()
     flow = Flow.from_client_config(
         _load_credentials_config(),
         SCOPES,
         redirect_uri=redirect_uri,
     )
-    auth_url, _ = flow.authorization_url(prompt="consent", state=str(user_id))
-    return auth_url, flow
+    state = f"{user_id}.{secrets.token_urlsafe(16)}"
+    auth_url, _ = flow.authorization_url(prompt="consent", state=state)
+    flow_state = {
+        "state": state,
+        "code_verifier": flow.code_verifier,
+        "redirect_uri": redirect_uri,
+    }
+    return auth_url, flow_state
 
 
-def finish_auth_flow(user_id: int, flow: Flow, code: str):
-    """Complete OAuth flow using the original flow object and store credentials."""
-    flow.fetch_token(code=code)
-    creds = flow.credentials
-    TOKEN_DIR.mkdir(exist_ok=True)
-    token_path = TOKEN_DIR / f"token_{user_id}.json"
-    with open(token_path, "w") as token_file:
-        token_file.write(creds.to_json())
-    return build('calendar', 'v3', credentials=creds)
+def user_id_from_state(state: str) -> int:
+    """The user an OAuth ``state`` parameter was issued for."""
+    return int(state.split(".", 1)[0])
 
 
-def _calendar_pref_path(user_id: int) -> Path:
-    TOKEN_DIR.mkdir(exist_ok=True)
-    return TOKEN_DIR / f"{CALENDAR_PREF_PREFIX}{user_id}.json"
+def finish_auth_flow(user_id: int, flow_state: dict, code: str):
+    """Rebuild the flow from ``flow_state``, exchange ``code`` and store credentials."""
+    from google_auth_oauthlib.flow import Flow
+
+    flow = Flow.from_client_config(
+        _load_credentials_config(),
+        SCOPES,
+        redirect_uri=flow_state.get("redirect_uri"),
+        state=flow_state["state"],
+        code_verifier=flow_state.get("code_verifier"),
+    )
+    flow.fetch_token(code=code)
+    creds = flow.credentials
+    _save_token(user_id, creds.to_json())
+    service = _build_service(creds)
+    _cache_service(user_id, creds, service)
+    return service
 
 
 def store_user_calendar_id(user_id: int, calendar_id: str) -> None:
-    path = _calendar_pref_path(user_id)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump({"calendar_id": calendar_id}, f)
+    get_store().set_calendar_id(user_id, calendar_id)
 
 
 def load_user_calendar_id(user_id: int) -> str | None:
-    path = _calendar_pref_path(user_id)
-    if not path.exists():
-        return None
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        calendar_id = data.get("calendar_id")
-        if isinstance(calendar_id, str) and calendar_id:
-            return calendar_id
-    except (json.JSONDecodeError, OSError):
-        return None
-    return None
+    return get_store().get_calendar_id(user_id)
 
 
 def list_calendars(service):
@@ -164,18 +282,7 @@ def create_event(
     color_id="",
     calendar_id="primary",
 ):
-    start_time = datetime.strptime(start_time_str, "%Y-%m-%d %H:%M")
-    end_time = start_time + timedelta(minutes=duration_minutes)
-
-    body = {
-        "summary": summary,
-        "start": {"dateTime": start_time.isoformat(), "timeZone": "Asia/Jerusalem"},
-        "end":   {"dateTime": end_time.isoformat(),   "timeZone": "Asia/Jerusalem"},
-    }
-
-    if color_id:
-        body["colorId"] = str(color_id)
-
+    body = event_body(summary, start_time_str, duration_minutes, color_id)
     event = service.events().insert(
         calendarId=calendar_id,
         body=body,
@@ -183,66 +290,137 @@ def create_event(
     ).execute()
     return event
 
-def find_event(service, user_text, calendar_id="primary"):
-    """
-    Searches for an event based on partial text match in the upcoming 7 days.
-    Returns the best matching event or None.
-    """
-    now = datetime.utcnow().isoformat() + "Z"
-    later = (datetime.utcnow() + timedelta(days=7)).isoformat() + "Z"
 
-    events_result = service.events().list(
-        calendarId=calendar_id,
-        timeMin=now,
-        timeMax=later,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-
-    events = events_result.get('items', [])
-    matches = []
+def event_times(start_time_str, duration_minutes=60) -> dict:
+    """``start``/``end`` fields for a local "YYYY-MM-DD HH:MM" start."""
+    start_time = datetime.strptime(start_time_str, "%Y-%m-%d %H:%M")
+    end_time = start_time + timedelta(minutes=duration_minutes)
+    return {
+        "start": {"dateTime": start_time.isoformat(), "timeZone": "Asia/Jerusalem"},
+        "end":   {"dateTime": end_time.isoformat(),   "timeZone": "Asia/Jerusalem"},
+    }
 
-    for event in events:
-        summary = event.get("summary", "")
-        if summary and user_text.strip() in summary:
-            matches.append(event)
 
-    if matches:
-        return matches[0]  # First match for now (can improve later)
+def event_body(summary, start_time_str, duration_minutes=60, color_id="") -> dict:
+    body = {"summary": summary, **event_times(start_time_str, duration_minutes)}
+    if color_id:
+        body["colorId"] = str(color_id)
+    return body
+
+
+def update_body(updates) -> dict:
+    """Patch body with only the fields ``updates`` changes."""
+    body = {}
+    if updates.get("summary"):
+        body["summary"] = updates["summary"]
+    if updates.get("start_time"):
+        body.update(
+            event_times(updates["start_time"], updates.get("duration_minutes") or 60)
+        )
+    if updates.get("color_id"):
+        body["colorId"] = str(updates["color_id"])
+    return body
+
+def list_events(service, time_min, time_max, calendar_id="primary"):
+    """
+    Returns all single events between two RFC3339 timestamps, by start time.
+    """
+    events = []
+    page_token = None
+    while True:
+        events_result = service.events().list(
+            calendarId=calendar_id,
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=True,
+            orderBy='startTime',
+            pageToken=page_token,
+        ).execute()
+        events.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return events
 
-    return None
 
 def delete_event(service, event_id, calendar_id="primary"):
     """
     Deletes an event by ID.
     """
     service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
-    print("🗑️ האירוע נמחק בהצלחה.")
+    log("event_deleted", event_id=event_id, calendar_id=calendar_id)
+
+def _patch_request(service, event_id, body, calendar_id, etag=None):
+    request = service.events().patch(
+        calendarId=calendar_id, eventId=event_id, body=body, sendUpdates="none"
+    )
+    if etag:
+        # Only apply the change to the version of the event we matched.
+        request.headers["If-Match"] = etag
+    return request
 
-def update_event(service, event_id, updates, calendar_id="primary"):
+
+def update_event(service, event_id, updates, calendar_id="primary", etag=None):
     """
-    Updates an existing event with new values.
+    Updates an existing event with new values in a single patch.
     updates = {
         "summary": "...",
         "start_time": "YYYY-MM-DD HH:MM",
-        "duration_minutes": ...
+        "duration_minutes": ...,
+        "color_id": "..."
     }
+    With ``etag`` the patch is conditional: if the event changed since it
+    was read, Google answers 412 and the HttpError is raised so the caller
+    can ask again instead of overwriting the other change.
     """
-    event = service.events().get(calendarId=calendar_id, eventId=event_id).execute()
-
-    if "summary" in updates:
-        event['summary'] = updates['summary']
-
-    if "start_time" in updates:
-        start = datetime.strptime(updates["start_time"], "%Y-%m-%d %H:%M")
-        end = start + timedelta(minutes=updates.get("duration_minutes", 60))
-        event['start'] = {"dateTime": start.isoformat(), "timeZone": "Asia/Jerusalem"}
-        event['end'] = {"dateTime": end.isoformat(), "timeZone": "Asia/Jerusalem"}
-
-    updated_event = service.events().update(
-        calendarId=calendar_id, eventId=event_id, body=event
-    ).execute()
-    print("✅ האירוע עודכן בהצלחה.")
+    body = update_body(updates)
+    updated_event = _patch_request(service, event_id, body, calendar_id, etag).execute()
+    log("event_updated", event_id=event_id, calendar_id=calendar_id)
+    return updated_event
+
+
+def _mutation_request(service, operation, calendar_id):
+    action = operation["action"]
+    if action == "create":
+        return service.events().insert(
+            calendarId=calendar_id, body=operation["body"], sendUpdates="none"
+        )
+    if action == "update":
+        return _patch_request(
+            service, operation["event_id"], operation["body"], calendar_id,
+            operation.get("etag"),
+        )
+    if action == "delete":
+        return service.events().delete(
+            calendarId=calendar_id, eventId=operation["event_id"], sendUpdates="none"
+        )
+    raise ValueError(f"Unknown operation: {action}")
+
+
+def batch_mutate(service, operations, calendar_id="primary"):
+    """
+    Runs create/update/delete operations as batch requests, up to
+    ``BATCH_LIMIT`` per HTTP round trip.
+    operations = [
+        {"action": "create", "body": {...}},
+        {"action": "update", "event_id": "...", "body": {...}, "etag": "..."},
+        {"action": "delete", "event_id": "..."},
+    ]
+    Returns ``(response, error)`` for each operation, in order.
+    """
+    results = [(None, None)] * len(operations)
+    requests = [_mutation_request(service, op, calendar_id) for op in operations]
+
+    def callback(request_id, response, exception):
+        i = int(request_id)
+        results[i] = (response, exception)
+        calendar_gateway.count_batched(requests[i], exception)
+
+    for offset in range(0, len(operations), BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for i in range(offset, min(offset + BATCH_LIMIT, len(operations))):
+            batch.add(requests[i], request_id=str(i))
+        batch.execute()
+    return results
 
 # Main program flow
 if __name__ == "__main__":
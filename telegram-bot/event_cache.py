@@ -0,0 +1,268 @@
+import os
+import re
+import math
+import time
+import bisect
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+LOCAL_TZ = ZoneInfo("Asia/Jerusalem")
+
+# How long a range loaded by a plain listing is trusted without the change
+# poller confirming it.
+EVENT_CACHE_MAX_AGE = float(os.getenv("EVENT_CACHE_MAX_AGE", 120))
+
+# Title matching: candidates below MIN_MATCH_SIMILARITY (trigram Dice
+# coefficient) are ignored; a requested start time adds up to
+# PROXIMITY_WEIGHT, decaying with distance over PROXIMITY_SCALE seconds.
+MIN_MATCH_SIMILARITY = float(os.getenv("MIN_MATCH_SIMILARITY", 0.4))
+# Deleting needs the title quoted verbatim or nearly so.
+DELETE_MIN_SIMILARITY = float(os.getenv("DELETE_MIN_SIMILARITY", 0.8))
+PROXIMITY_WEIGHT = float(os.getenv("PROXIMITY_WEIGHT", 0.5))
+PROXIMITY_SCALE = float(os.getenv("PROXIMITY_SCALE", 6 * 3600))
+
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_SPACE_RE = re.compile(r"\s+")
+_FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+
+
+def parse_event_time(value: dict) -> datetime | None:
+    if value.get("dateTime"):
+        dt = datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt
+    if value.get("date"):
+        day = datetime.fromisoformat(value["date"])
+        return day.replace(tzinfo=LOCAL_TZ)
+    return None
+
+
+def event_bounds(event: dict):
+    """Return ``(start_ts, end_ts)`` epoch seconds, or ``None`` if untimed."""
+    start = parse_event_time(event.get("start", {}))
+    if start is None:
+        return None
+    end = parse_event_time(event.get("end", {})) or start
+    return start.timestamp(), end.timestamp()
+
+
+def normalize_title(title: str) -> str:
+    """Lowercase, drop punctuation/acronym quotes and unify final letters."""
+    title = _PUNCT_RE.sub("", title.lower()).translate(_FINAL_LETTERS)
+    return _SPACE_RE.sub(" ", title).strip()
+
+
+def title_ngrams(title: str) -> set:
+    """Character trigrams of the normalized title, padded at the edges."""
+    padded = f" {normalize_title(title)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class EventCache:
+    """Events of one user calendar, indexed by start time and title trigrams.
+
+    ``_ranges`` lists the disjoint ``(start_ts, end_ts, synced_at)`` ranges
+    (epoch seconds, ``math.inf`` = open ended) the cache holds completely,
+    each with the monotonic time it was last confirmed against Google.
+    """
+
+    def __init__(self):
+        self.events: dict = {}
+        self._bounds: dict = {}
+        self._starts: list = []
+        self._grams: dict = defaultdict(set)
+        self._titles: dict = {}
+        # event_id -> number of trigrams of its title, for the Dice score.
+        self._gram_counts: dict = {}
+        self._max_duration = 0.0
+        self._ranges: list = []
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    # Updates
+
+    def upsert(self, event: dict) -> None:
+        if event.get("status") == "cancelled":
+            self.remove(event["id"])
+            return
+        bounds = event_bounds(event)
+        if bounds is None:
+            return
+        self.remove(event["id"])
+        event_id = event["id"]
+        self.events[event_id] = event
+        self._bounds[event_id] = bounds
+        bisect.insort(self._starts, (bounds[0], event_id))
+        self._max_duration = max(self._max_duration, bounds[1] - bounds[0])
+        title = normalize_title(event.get("summary", ""))
+        self._titles[event_id] = title
+        grams = title_ngrams(title)
+        self._gram_counts[event_id] = len(grams)
+        for gram in grams:
+            self._grams[gram].add(event_id)
+
+    def remove(self, event_id: str) -> None:
+        event = self.events.pop(event_id, None)
+        if event is None:
+            return
+        bounds = self._bounds.pop(event_id)
+        i = bisect.bisect_left(self._starts, (bounds[0], event_id))
+        if i < len(self._starts) and self._starts[i] == (bounds[0], event_id):
+            del self._starts[i]
+        del self._gram_counts[event_id]
+        for gram in title_ngrams(self._titles.pop(event_id)):
+            ids = self._grams.get(gram)
+            if ids:
+                ids.discard(event_id)
+                if not ids:
+                    del self._grams[gram]
+
+    def apply(self, events) -> None:
+        for event in events:
+            self.upsert(event)
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def replace_range(self, events, start_ts: float, end_ts: float = math.inf) -> None:
+        """Store a complete listing of ``[start_ts, end_ts)``."""
+        for event_id in [e["id"] for e in self.between(start_ts, end_ts)]:
+            self.remove(event_id)
+        self.apply(events)
+        self._cover(start_ts, end_ts)
+
+    def prune_before(self, ts: float) -> None:
+        """Drop events that ended before ``ts``; they cannot change alerts."""
+        cutoff = bisect.bisect_left(self._starts, (ts,))
+        for start, event_id in self._starts[:cutoff]:
+            if self._bounds[event_id][1] <= ts:
+                self.remove(event_id)
+        self._ranges = [
+            (max(start, ts), end, synced_at)
+            for start, end, synced_at in self._ranges
+            if end > ts
+        ]
+
+    def _cover(self, start_ts: float, end_ts: float) -> None:
+        """Mark ``[start_ts, end_ts)`` as freshly listed.
+
+        Only that interval becomes fresh; the parts of older ranges outside
+        it keep their own sync time.
+        """
+        ranges = []
+        for start, end, synced_at in self._ranges:
+            if end <= start_ts or start >= end_ts:
+                ranges.append((start, end, synced_at))
+                continue
+            if start < start_ts:
+                ranges.append((start, start_ts, synced_at))
+            if end > end_ts:
+                ranges.append((end_ts, end, synced_at))
+        ranges.append((start_ts, end_ts, time.monotonic()))
+        ranges.sort()
+        self._ranges = ranges
+
+    def mark_synced(self) -> None:
+        """Confirm every held range, after applying a complete change feed."""
+        now = time.monotonic()
+        merged = []
+        for start, end, _ in self._ranges:
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], end, now)
+            else:
+                merged.append((start, end, now))
+        self._ranges = merged
+
+    # Queries
+
+    def bounds_of(self, event: dict):
+        """Like :func:`event_bounds`, reusing the parse done when it was cached."""
+        return self._bounds.get(event["id"]) or event_bounds(event)
+
+    def covers(self, start_ts: float, end_ts: float, max_age: float = EVENT_CACHE_MAX_AGE) -> bool:
+        """Whether ``[start_ts, end_ts)`` is held by ranges synced within ``max_age``."""
+        oldest = time.monotonic() - max_age
+        reached = start_ts
+        for start, end, synced_at in self._ranges:
+            if end <= reached:
+                continue
+            if start > reached or synced_at < oldest:
+                return False
+            reached = end
+            if reached >= end_ts:
+                return True
+        return False
+
+    def between(self, start_ts: float, end_ts: float = math.inf) -> list:
+        """Events overlapping ``[start_ts, end_ts)`` ordered by start."""
+        lo = bisect.bisect_left(self._starts, (start_ts - self._max_duration,))
+        hi = bisect.bisect_left(self._starts, (end_ts,))
+        return [
+            self.events[event_id]
+            for _, event_id in self._starts[lo:hi]
+            if self._bounds[event_id][1] > start_ts
+        ]
+
+    def rank(
+        self,
+        text: str,
+        start_ts: float,
+        end_ts: float,
+        target_ts: float | None = None,
+        proximity_weight: float = PROXIMITY_WEIGHT,
+        min_similarity: float = MIN_MATCH_SIMILARITY,
+    ) -> list:
+        """Events in the range matching ``text``, best first.
+
+        Similarity is the trigram Dice coefficient, with titles that contain
+        the query verbatim always ranked above fuzzy matches; other titles
+        below ``min_similarity`` are left out. When
+        ``target_ts`` is given, events starting close to it score higher.
+        Ties go to the earlier event. Returns ``[(score, event), ...]``.
+        """
+        needle = normalize_title(text)
+        if not needle:
+            return []
+        query = title_ngrams(needle)
+        shared = Counter()
+        for gram in query:
+            shared.update(self._grams.get(gram, ()))
+        if len(needle) < 3:
+            # Too short for trigrams to be selective; check every event.
+            for event in self.between(start_ts, end_ts):
+                shared.setdefault(event["id"], 0)
+
+        ranked = []
+        for event_id, common in shared.items():
+            ev_start, ev_end = self._bounds[event_id]
+            if ev_end <= start_ts or ev_start >= end_ts:
+                continue
+            title = self._titles[event_id]
+            grams = self._gram_counts[event_id]
+            similarity = 2 * common / (len(query) + grams) if grams else 0.0
+            if needle in title:
+                similarity = 1.0 + min(similarity, 1.0)
+            elif similarity < min_similarity:
+                continue
+            score = similarity
+            if target_ts is not None:
+                distance = abs(ev_start - target_ts)
+                score += proximity_weight * math.exp(-distance / PROXIMITY_SCALE)
+            ranked.append((score, ev_start, event_id))
+
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+        return [(score, self.events[event_id]) for score, _, event_id in ranked]
+
+
+_caches: dict = {}
+
+
+def get_cache(user_id: int, calendar_id: str) -> EventCache:
+    """Return the cache for the user's current calendar, resetting on switch."""
+    entry = _caches.get(user_id)
+    if entry is None or entry[0] != calendar_id:
+        entry = _caches[user_id] = (calendar_id, EventCache())
+    return entry[1]
@@ -0,0 +1,493 @@
+import os
+import json
+import zlib
+import math
+import time
+import asyncio
+import traceback
+from functools import partial
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
+from telegram.ext import ContextTypes
+
+import calendar_gateway
+from create_event import (
+    authenticate_google_calendar,
+    invalidate_user_service,
+    load_user_calendar_id,
+)
+from event_cache import EVENT_CACHE_MAX_AGE, EventCache, event_bounds, get_cache
+from metrics import POLL_LAG, POLL_SECONDS, log, request_scope
+from outbox import outbox_notifier
+from state_store import get_store
+from tracked_events import TrackedEvent, TrackedEvents, local_strings
+
+BASE_DIR = Path(__file__).resolve().parent
+
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 60))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", 10))
+# Each user polls at a fixed offset inside this window so a tick does not
+# fire every user's request at once.
+POLL_JITTER = float(os.getenv("POLL_JITTER", POLL_INTERVAL / 3))
+# A tick that is still running after this many seconds is cut short so it
+# never overlaps the next one; unfinished users are picked up next tick.
+POLL_BUDGET = POLL_INTERVAL * 0.9
+# "incremental" keeps a local mirror updated through syncToken listings;
+# "full" re-lists the whole 24h window on every poll.
+SYNC_MODE = os.getenv("SYNC_MODE", "incremental")
+LOOKAHEAD = timedelta(hours=24)
+# Users with a live push channel are still polled this often as a safety net
+# against dropped notifications.
+WATCHED_POLL_INTERVAL = int(os.getenv("WATCHED_POLL_INTERVAL", 900))
+
+# Telegram messages are limited to 4096 characters; longer digests are split.
+MESSAGE_LIMIT = 4000
+# A user is told about failing polls at most this often.
+POLL_ERROR_NOTIFY_INTERVAL = float(os.getenv("POLL_ERROR_NOTIFY_INTERVAL", 3600))
+
+_poll_locks: dict = {}
+_error_notified: dict = {}
+
+with open(BASE_DIR / "notification_templates.json", "r", encoding="utf-8") as f:
+    TEMPLATES = json.load(f)
+
+
+def render_message(key, **kwargs):
+    template = TEMPLATES.get(key, "")
+    return template.format(**kwargs)
+
+
+def render_alerts(alerts: list) -> list:
+    """Texts to send for one poll's alerts.
+
+    A single change gets its own message; several become one digest (split
+    only if it would exceed Telegram's message size).
+    """
+    if len(alerts) <= 1:
+        return [render_message(key, **fields) for key, fields in alerts]
+    texts = []
+    current = render_message("digest_header", count=len(alerts))
+    for key, fields in alerts:
+        line = render_message(f"digest_{key}", **fields)
+        if len(current) + len(line) + 1 > MESSAGE_LIMIT:
+            texts.append(current)
+            current = line
+        else:
+            current += "\n" + line
+    texts.append(current)
+    return texts
+
+
+def diff_events(
+    tracked: TrackedEvents,
+    events: list,
+    now_ts: float | None = None,
+    bounds=event_bounds,
+    on_change=None,
+) -> list:
+    """Update ``tracked`` from a fresh 24h listing.
+
+    Events whose ``updated`` marker is unchanged are skipped without
+    parsing. Events that ended leave through the expiry heap without an
+    alert; the remaining records are only scanned when some tracked event
+    is missing from the listing. ``bounds`` returns an event's
+    ``(start_ts, end_ts)``; ``on_change(event_id, record, event)`` is called
+    for every new or changed record and with ``None`` for records that are
+    dropped. Returns the alerts as ``(template_key, fields)`` pairs.
+    """
+    if now_ts is None:
+        now_ts = time.time()
+    messages = []
+    seen = {}
+    tracked_seen = 0
+
+    for ev in events:
+        ev_id = ev["id"]
+        seen[ev_id] = ev
+        updated = ev.get("updated")
+        previous = tracked.get(ev_id)
+        if previous is not None:
+            tracked_seen += 1
+            if previous.updated == updated:
+                continue
+        times = bounds(ev)
+        if times is None:
+            if previous is not None:
+                tracked_seen -= 1
+                tracked.remove(ev_id)
+                if on_change:
+                    on_change(ev_id, None, ev)
+            continue
+        record = TrackedEvent(*times, ev.get("summary", "ללא כותרת"), updated)
+        if previous is None:
+            tracked_seen += 1
+        elif previous.start != record.start or previous.title_hash != record.title_hash:
+            old_time, old_date = local_strings(previous.start)
+            new_time, new_date = local_strings(record.start)
+            messages.append((
+                "event_updated",
+                {
+                    "summary": record.summary,
+                    "old_time": old_time,
+                    "old_date": old_date,
+                    "new_time": new_time,
+                    "new_date": new_date,
+                },
+            ))
+        tracked.set(ev_id, record)
+        if on_change:
+            on_change(ev_id, record, ev)
+
+    for ev_id, record in tracked.pop_expired(now_ts):
+        ev = seen.get(ev_id)
+        end = bounds(ev)[1] if ev is not None else now_ts
+        if end > now_ts:
+            # Still running (its end was not known yet).
+            tracked.reschedule(ev_id, end)
+        else:
+            if ev is not None:
+                tracked_seen -= 1
+            tracked.remove(ev_id)
+            if on_change:
+                on_change(ev_id, None, ev)
+
+    if len(tracked) > tracked_seen:
+        horizon = now_ts + LOOKAHEAD.total_seconds()
+        for ev_id in [eid for eid in tracked if eid not in seen]:
+            record = tracked.remove(ev_id)
+            if on_change:
+                on_change(ev_id, None, None)
+            if now_ts <= record.start <= horizon:
+                old_time, old_date = local_strings(record.start)
+                messages.append((
+                    "event_deleted",
+                    {"summary": record.summary, "old_time": old_time, "old_date": old_date},
+                ))
+
+    return messages
+
+
+def window_events(cache: EventCache, now: datetime) -> list:
+    """Events overlapping ``[now, now + 24h)`` ordered by start.
+
+    Mirrors what ``events().list(timeMin=now, timeMax=now+24h,
+    orderBy="startTime")`` returns, so diffs match the full listing.
+    """
+    now_ts = now.timestamp()
+    return cache.between(now_ts, now_ts + LOOKAHEAD.total_seconds())
+
+
+async def _list_all(user_id: int, service, **params):
+    """Follow ``nextPageToken`` and return ``(items, nextSyncToken)``."""
+    items = []
+    page_token = None
+    while True:
+        result = await calendar_gateway.execute(
+            user_id,
+            service.events().list(pageToken=page_token, maxResults=2500, **params),
+        )
+        items.extend(result.get("items", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return items, result.get("nextSyncToken")
+
+
+async def _list_window(
+    user_id: int, service, calendar_id: str, cache: EventCache, now: datetime
+) -> list:
+    events_result = await calendar_gateway.execute(
+        user_id,
+        service.events().list(
+            calendarId=calendar_id,
+            timeMin=now.isoformat(),
+            timeMax=(now + LOOKAHEAD).isoformat(),
+            singleEvents=True,
+            orderBy="startTime",
+        ),
+    )
+    items = events_result.get("items", [])
+    cache.replace_range(
+        items, now.timestamp(), (now + LOOKAHEAD).timestamp()
+    )
+    return items
+
+
+async def _sync_window(
+    user_id: int, service, calendar_id: str, sync: dict, cache: EventCache, now: datetime
+) -> list:
+    """Bring the event cache up to date and return the 24h window from it.
+
+    ``sync`` holds the ``token`` for one calendar. Only changed/cancelled
+    events are fetched once a sync token exists; a 410 Gone triggers a full
+    resync of everything from now on.
+    """
+    changed = None
+    if sync.get("token"):
+        try:
+            changed, next_token = await _list_all(
+                user_id,
+                service,
+                calendarId=calendar_id,
+                singleEvents=True,
+                syncToken=sync["token"],
+            )
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            log("sync_token_expired", user_id=user_id)
+
+    if changed is None:
+        items, next_token = await _list_all(
+            user_id,
+            service,
+            calendarId=calendar_id,
+            singleEvents=True,
+            timeMin=now.isoformat(),
+        )
+        cache.replace_range(items, now.timestamp())
+        if not next_token:
+            # Without a token we cannot go incremental; keep listing in full.
+            log("sync_token_missing", user_id=user_id)
+            sync["unsupported"] = True
+    else:
+        cache.apply(changed)
+        cache.mark_synced()
+    sync["token"] = next_token
+
+    # Forget events that are already over; they can never re-enter the window.
+    cache.prune_before(now.timestamp())
+
+    return window_events(cache, now)
+
+
+async def poll_user(
+    user_id: int, chat_id: int, tracked_events: dict, sync_state: dict, notify, reminders=None
+) -> None:
+    """Diff one user's next 24 hours against their tracked state.
+
+    ``tracked_events`` maps ``user_id -> {calendar_id: TrackedEvents}``
+    and ``sync_state`` maps ``user_id -> {calendar_id: sync}``; only the
+    calendar currently selected by the user is kept. ``notify`` is an
+    ``async (chat_id, text)`` callable. ``reminders`` (a
+    ``ReminderScheduler``) is kept up to date from the same listing.
+    """
+    service = await calendar_gateway.run(
+        user_id, authenticate_google_calendar, user_id, stage="credentials"
+    )
+    if not service:
+        return
+
+    calendar_id = load_user_calendar_id(user_id)
+    if not calendar_id:
+        return
+
+    store = get_store()
+    per_user = tracked_events.setdefault(user_id, {})
+    if calendar_id not in per_user:
+        if per_user:
+            # The user switched calendars; state for the old one would only
+            # produce false "deleted" alerts.
+            per_user.clear()
+            store.clear_tracked(user_id)
+        # Restored from the store, so a restart does not look like every
+        # tracked event was deleted.
+        per_user[calendar_id] = TrackedEvents(store.load_tracked(user_id, calendar_id))
+    tracked = per_user[calendar_id]
+    user_sync = sync_state.setdefault(user_id, {})
+    if calendar_id not in user_sync:
+        user_sync.clear()
+    sync = user_sync.setdefault(calendar_id, {})
+    cache = get_cache(user_id, calendar_id)
+
+    try:
+        now = datetime.now(timezone.utc)
+        if SYNC_MODE == "incremental" and not sync.get("unsupported"):
+            events = await _sync_window(user_id, service, calendar_id, sync, cache, now)
+        else:
+            events = await _list_window(user_id, service, calendar_id, cache, now)
+        on_change = None
+        if reminders is not None and reminders.watching(user_id, calendar_id):
+            on_change = partial(reminders.event_changed, user_id)
+        alerts = diff_events(tracked, events, now.timestamp(), cache.bounds_of, on_change)
+        if reminders is not None and on_change is None:
+            reminders.replace(user_id, chat_id, calendar_id, events, cache.bounds_of)
+        changed, removed = tracked.take_changes()
+        if changed or removed:
+            store.save_tracked(user_id, calendar_id, changed, removed)
+        for text in render_alerts(alerts):
+            await notify(chat_id, text)
+        _error_notified.pop(user_id, None)
+
+    except RefreshError:
+        invalidate_user_service(user_id)
+    except Exception as e:
+        log("poll_user_failed", user_id=user_id, error=repr(e))
+        traceback.print_exc()
+        last = _error_notified.get(user_id)
+        if last is None or time.monotonic() - last >= POLL_ERROR_NOTIFY_INTERVAL:
+            _error_notified[user_id] = time.monotonic()
+            await notify(chat_id, render_message("poll_error", error=e))
+
+
+async def poll_and_notify(bot_data: dict, notify, user_id: int) -> None:
+    """Poll ``user_id`` with the shared bot_data state, one poll at a time."""
+    lock = _poll_locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        # Private chats share the user's id, which covers users who have
+        # not written since the last restart.
+        chat_id = get_store().get_chat_id(user_id) or user_id
+        await poll_user(
+            user_id,
+            chat_id,
+            bot_data.setdefault("tracked_events", {}),
+            bot_data.setdefault("sync_state", {}),
+            notify,
+            bot_data.get("reminders"),
+        )
+        bot_data.setdefault("last_polled", {})[user_id] = time.monotonic()
+
+
+def polls_user(bot_data: dict, user_id: int) -> bool:
+    """Whether this instance holds the poll lease covering ``user_id``."""
+    leases = bot_data.get("poll_leases")
+    return leases is None or leases.owns(user_id)
+
+
+async def renew_poll_leases(context: ContextTypes.DEFAULT_TYPE):
+    """Keep this instance's poll leases alive and rebalance shards."""
+    bot_data = context.bot_data
+    leases = bot_data["poll_leases"]
+    try:
+        gained = leases.renew()
+    except Exception as e:
+        # Our leases run out on their own; polling stops until renewal works.
+        log("lease_renew_failed", error=repr(e))
+        return
+    workers = bot_data.get("shard_workers")
+    if workers:
+        workers.publish_leases(leases)
+    if gained:
+        forget_users(bot_data, lambda u: leases.shard_of(u) in gained)
+        log("shards_owned", shards=sorted(leases.owned_shards()), total=leases.shards)
+
+
+def forget_users(bot_data: dict, predicate) -> None:
+    """Drop in-memory poll state of users matching ``predicate``.
+
+    Used when another instance may have polled them in the meantime, so
+    the next poll starts over from the shared store instead of stale memory.
+    """
+    for key in ("tracked_events", "sync_state", "last_polled"):
+        state = bot_data.get(key, {})
+        for user_id in [u for u in state if predicate(u)]:
+            del state[user_id]
+    reminders = bot_data.get("reminders")
+    if reminders is not None:
+        reminders.forget(predicate)
+
+
+async def refresh_user(bot_data: dict, user_id: int) -> None:
+    """Poll one user immediately, e.g. after a push notification."""
+    if not polls_user(bot_data, user_id):
+        return
+    workers = bot_data.get("shard_workers")
+    if workers:
+        # The user's poll state lives in a worker process.
+        workers.refresh(user_id)
+        return
+    try:
+        await poll_and_notify(bot_data, outbox_notifier(bot_data["outbox"]), user_id)
+    except Exception as e:
+        log("immediate_poll_failed", user_id=user_id, error=repr(e))
+        traceback.print_exc()
+
+
+def _needs_poll(bot_data: dict, user_id: int) -> bool:
+    """Users covered by a push channel only need the occasional safety poll."""
+    if not bot_data.get("user_channels", {}).get(user_id):
+        return True
+    last = bot_data.get("last_polled", {}).get(user_id)
+    return last is None or time.monotonic() - last >= WATCHED_POLL_INTERVAL
+
+
+def cache_max_age(bot_data: dict, user_id: int) -> float:
+    """How long the user's event cache can be trusted without a poll.
+
+    Push channels report every change, so the cache of a watched user stays
+    valid until the next safety poll is due. With shard workers the pushes
+    refresh the worker's cache, not this process's, so only the plain
+    listing age applies.
+    """
+    if bot_data.get("shard_workers"):
+        return EVENT_CACHE_MAX_AGE
+    if bot_data.get("user_channels", {}).get(user_id):
+        return WATCHED_POLL_INTERVAL + POLL_INTERVAL
+    return EVENT_CACHE_MAX_AGE
+
+
+def _poll_offset(user_id: int) -> float:
+    """Stable per-user start offset inside the jitter window."""
+    jitter = min(POLL_JITTER, POLL_BUDGET / 2)
+    return (zlib.crc32(str(user_id).encode()) % 1000) / 1000 * jitter
+
+
+async def poll_users(bot_data: dict, users, notify) -> None:
+    """Poll ``users`` with a bounded fan-out inside ``POLL_BUDGET``.
+
+    Users the previous tick did not get to start right away, least
+    recently polled first, so an overloaded instance does not cut off the
+    same users every time.
+    """
+    if bot_data.get("poll_running"):
+        log("poll_skipped", reason="previous tick running")
+        return
+    semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+    last_polled = bot_data.setdefault("last_polled", {})
+    deferred = bot_data.get("poll_deferred", set())
+    users = sorted(users, key=lambda u: last_polled.get(u, -math.inf))
+
+    async def poll_one(user_id):
+        if user_id not in deferred:
+            await asyncio.sleep(_poll_offset(user_id))
+        async with semaphore:
+            await poll_and_notify(bot_data, notify, user_id)
+
+    started = time.monotonic()
+    bot_data["poll_running"] = True
+    try:
+        with request_scope("poll", users=len(users)):
+            results = await asyncio.wait_for(
+                asyncio.gather(*(poll_one(u) for u in users), return_exceptions=True),
+                timeout=POLL_BUDGET,
+            )
+            for user_id, result in zip(users, results):
+                if isinstance(result, Exception):
+                    log("poll_failed", user_id=user_id, error=repr(result))
+    except asyncio.TimeoutError:
+        log("poll_budget_exceeded", budget_s=POLL_BUDGET)
+    finally:
+        POLL_SECONDS.observe(time.monotonic() - started)
+        bot_data["poll_deferred"] = {
+            u for u in users if last_polled.get(u, -math.inf) < started
+        }
+        bot_data["poll_running"] = False
+
+
+async def check_event_changes(context: ContextTypes.DEFAULT_TYPE):
+    """Poll every approved user this instance is responsible for."""
+    bot_data = context.bot_data
+    now = time.monotonic()
+    previous = bot_data.get("last_poll_tick")
+    if previous is not None:
+        POLL_LAG.set(max(0.0, now - previous - POLL_INTERVAL))
+    bot_data["last_poll_tick"] = now
+    users = [
+        u
+        for u in get_store().approved_users()
+        if polls_user(bot_data, u) and _needs_poll(bot_data, u)
+    ]
+    if users:
+        await poll_users(bot_data, users, outbox_notifier(bot_data["outbox"]))
@@ -13,3 +13,42 @@ COLORID_TO_EMOJI = {
 
 def emoji_for_color(color_id):
     return COLORID_TO_EMOJI.get(str(color_id), "")
+
+
+# Minutes before an event its reminder is sent, per color; 0 turns reminders
+# off for that category.
+DEFAULT_REMINDER_MINUTES = 15
+COLORID_TO_REMINDER_MINUTES = {
+    "10": 15,   # basil - סגן
+    "5": 15,    # banana - סונאר
+    "6": 15,    # tangerine - צוות
+    "11": 30,   # tomato - מפקד
+    "2": 15,    # sage - סגל
+    "3": 15,    # grape - נשק
+    "1": 15,    # lavender - גנק
+    "8": 15,    # graphite - טכנית
+    "4": 30,    # flamingo - מבצעים
+}
+
+
+def reminder_minutes(color_id):
+    return COLORID_TO_REMINDER_MINUTES.get(str(color_id), DEFAULT_REMINDER_MINUTES)
+
+
+# Category keywords used in commands, matching xo_assistance_prompt.txt.
+CATEGORY_TO_COLORID = {
+    "טכנית": "8",
+    "מבצעים": "4",
+    "גנק": "1",
+    "סגל": "2",
+    "סונר": "5",
+    "סונאר": "5",
+    "נשק": "3",
+    "מפקד": "11",
+    "סגן": "10",
+    "צוות": "6",
+}
+
+
+def color_for_category(word):
+    return CATEGORY_TO_COLORID.get(word.replace('"', "").replace("״", ""), "")
@@ -0,0 +1,26 @@
+import bisect
+import hashlib
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes.
+
+    Each node is placed ``replicas`` times on the ring so keys spread
+    evenly, and adding or removing a node only moves the keys next to it.
+    """
+
+    def __init__(self, nodes, replicas: int = 128):
+        self._ring = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    def node_for(self, key):
+        if not self._ring:
+            raise ValueError("HashRing has no nodes")
+        i = bisect.bisect(self._points, _hash(str(key))) % len(self._ring)
+        return self._ring[i][1]
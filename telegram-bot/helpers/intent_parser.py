@@ -0,0 +1,230 @@
+"""Rule-based parser for the most common Hebrew commands.
+
+Produces the same JSON shape as xo_assistance_prompt.txt together with a
+confidence score, so the caller can answer simple commands locally and
+send anything unusual to the LLM.
+"""
+import re
+from datetime import date, timedelta
+
+from helpers.colors import color_for_category
+
+VERBS = {
+    "summarize": ("סכם", "תסכם", "סיכום", "לוז", "מה יש לי", "מה בלוז"),
+    "delete": ("מחק", "תמחק", "למחוק", "בטל", "תבטל", "לבטל", "הסר", "תסיר"),
+    "update": (
+        "הזז", "תזיז", "להזיז", "העבר", "תעביר", "להעביר",
+        "דחה", "תדחה", "לדחות", "עדכן", "תעדכן", "לעדכן",
+    ),
+    "create": (
+        "קבע", "תקבע", "לקבוע", "הוסף", "תוסיף", "להוסיף",
+        "צור", "תיצור", "הכנס", "תכניס", "שים", "תשים",
+    ),
+}
+
+WEEKDAYS = {
+    "ראשון": 6,
+    "שני": 0,
+    "שלישי": 1,
+    "רביעי": 2,
+    "חמישי": 3,
+    "שישי": 4,
+    "שבת": 5,
+}
+
+RELATIVE_DAYS = {"היום": 0, "מחר": 1, "מחרתיים": 2}
+
+# Words that carry no meaning for the event title.
+FILLER = {"לי", "את", "בבקשה", "אירוע", "האירוע", "של", "ה", "ל", "ב", "יום"}
+
+# Anything that hints at more than one operation or a question goes to the LLM.
+COMPLEX_MARKERS = ("כל ה", "וגם", "?", "אם ", "כש", "אחרי ", "לפני ")
+
+_PREFIX = r"(?:^|(?<=\s))(?:ו?(?:ב|ל|של\s)?)"
+
+_RELATIVE_RE = re.compile(_PREFIX + r"(" + "|".join(sorted(RELATIVE_DAYS, key=len, reverse=True)) + r")(?=\s|$)")
+_WEEKDAY_RE = re.compile(
+    _PREFIX + r"(?:יום\s+(?:ה)?(" + "|".join(WEEKDAYS) + r")|(שבת))(?=\s|$)"
+)
+_DATE_RE = re.compile(r"(?:^|(?<=\s))(?:ב|ל)?-?(\d{1,2})[./](\d{1,2})(?:[./](\d{2,4}))?(?=\s|$)")
+_TIME_RE = re.compile(
+    r"(?:^|(?<=\s))(?:(?:ב|ל)?-?(?:שעה\s*)?|בשעה\s*)(\d{1,2}):(\d{2})(?=\s|$)"
+)
+_HOUR_ONLY_RE = re.compile(r"(?:^|(?<=\s))(?:ב|ל)שעה\s+(\d{1,2})(?=\s|$)")
+_DURATION_RE = re.compile(
+    r"(?:^|(?<=\s))(?:למשך\s+|ל-?)?(?:"
+    r"(\d{1,3})\s*(?:דקות|דק'|דק|ד')"
+    r"|(\d{1,2})\s*שעות"
+    r"|(שעה וחצי|חצי שעה|שעתיים|רבע שעה)"
+    r")(?=\s|$)"
+    r"|(?:^|(?<=\s))למשך\s+(שעה)(?=\s|$)"
+)
+_CATEGORY_RE = re.compile(
+    r"(?:^|(?<=\s))(?:סיווג|צבע|קטגוריה)\s*:?\s*(\S+)(?=\s|$)"
+)
+
+_NAMED_DURATIONS = {"שעה וחצי": 90, "חצי שעה": 30, "שעתיים": 120, "רבע שעה": 15, "שעה": 60}
+
+
+def normalize(text: str) -> str:
+    """Collapse whitespace and drop quote marks used in Hebrew acronyms."""
+    text = text.replace("״", "").replace('"', "").replace("׳", "'")
+    text = re.sub(r"[!.,]+$", "", text.strip())
+    return re.sub(r"\s+", " ", text)
+
+
+def command_key(text: str) -> str:
+    """Normalized form of a command for caching parsed intents.
+
+    Politeness words and punctuation that never change the meaning are
+    dropped so near-identical resends map to the same key.
+    """
+    text = normalize(text).lower()
+    text = re.sub(r"[!?,;()\[\]]", " ", text)
+    words = [w for w in text.split() if w not in ("בבקשה", "תודה", "פליז")]
+    return " ".join(words)
+
+
+def _match_verb(text: str):
+    for action, verbs in VERBS.items():
+        for verb in sorted(verbs, key=len, reverse=True):
+            if text == verb or text.startswith(verb + " "):
+                return action, text[len(verb):].strip()
+    return None, text
+
+
+def _extract_date(text: str, today: date):
+    """Return ``(date, rest, certain)``; ``certain`` is False when ambiguous."""
+    m = _RELATIVE_RE.search(text)
+    if m:
+        return today + timedelta(days=RELATIVE_DAYS[m.group(1)]), _cut(text, m), True
+    m = _WEEKDAY_RE.search(text)
+    if m:
+        weekday = WEEKDAYS[m.group(1) or m.group(2)]
+        ahead = (weekday - today.weekday()) % 7
+        # "Tuesday" said on a Tuesday could mean today or next week.
+        return today + timedelta(days=ahead), _cut(text, m), ahead != 0
+    m = _DATE_RE.search(text)
+    if m:
+        day, month, year = int(m.group(1)), int(m.group(2)), m.group(3)
+        year = int(year) if year else today.year
+        if year < 100:
+            year += 2000
+        try:
+            return date(year, month, day), _cut(text, m), True
+        except ValueError:
+            return None, text, False
+    return None, text, True
+
+
+def _extract_time(text: str):
+    m = _TIME_RE.search(text)
+    if m:
+        hour, minute = int(m.group(1)), int(m.group(2))
+    else:
+        m = _HOUR_ONLY_RE.search(text)
+        if not m:
+            return None, text
+        hour, minute = int(m.group(1)), 0
+    if hour > 23 or minute > 59:
+        return None, text
+    return (hour, minute), _cut(text, m)
+
+
+def _extract_duration(text: str):
+    m = _DURATION_RE.search(text)
+    if not m:
+        return None, text
+    minutes_str, hours_str, named, bare_hour = m.groups()
+    if minutes_str:
+        minutes = int(minutes_str)
+    elif hours_str:
+        minutes = int(hours_str) * 60
+    else:
+        minutes = _NAMED_DURATIONS[named or bare_hour]
+    return minutes, _cut(text, m)
+
+
+def _extract_color(text: str):
+    m = _CATEGORY_RE.search(text)
+    if m:
+        return color_for_category(m.group(1)), _cut(text, m)
+    for word in text.split():
+        color = color_for_category(word)
+        if not color and word[:1] in ("ה", "ל", "ב"):
+            color = color_for_category(word[1:])
+        if color:
+            # Keep the word: "ישיבת צוות" is both the title and the category.
+            return color, text
+    return "", text
+
+
+def _cut(text: str, match) -> str:
+    return (text[: match.start()] + " " + text[match.end():]).strip()
+
+
+def _clean_summary(text: str) -> str:
+    words = [w for w in text.split() if w not in FILLER]
+    while words and words[0] in ("את", "ה"):
+        words.pop(0)
+    return " ".join(words).strip(" -:")
+
+
+def parse_intent(text: str, today: date):
+    """Parse ``text`` into the LLM's JSON schema.
+
+    Returns ``(data, confidence)``; ``data`` is ``None`` when the command is
+    not recognised at all. Confidence is in ``[0, 1]``.
+    """
+    text = normalize(text)
+    if not text or any(marker in text for marker in COMPLEX_MARKERS):
+        return None, 0.0
+
+    action, rest = _match_verb(text)
+    if not action:
+        return None, 0.0
+
+    day, rest, day_certain = _extract_date(rest, today)
+
+    if action == "summarize":
+        leftover = _clean_summary(rest)
+        if day is None or leftover:
+            return None, 0.2
+        return {"action": "summarize", "date": day.isoformat()}, 0.95 if day_certain else 0.5
+
+    hm, rest = _extract_time(rest)
+    duration, rest = _extract_duration(rest)
+    color_id, rest = _extract_color(rest)
+    summary = _clean_summary(rest)
+    if not summary or len(summary.split()) > 5:
+        return None, 0.2
+
+    confidence = 0.9 if day_certain else 0.5
+    start_time = ""
+    if hm:
+        start_day = day or today
+        start_time = f"{start_day.isoformat()} {hm[0]:02d}:{hm[1]:02d}"
+        if day is None:
+            # Time without a date: most likely today, but let the LLM decide.
+            confidence = min(confidence, 0.6)
+
+    if action == "delete":
+        if duration:
+            confidence = min(confidence, 0.5)
+        data = {"action": "delete", "summary": summary, "start_time": start_time}
+        if day and not hm:
+            # A day without a time: only that day's instance may be deleted.
+            data["date"] = day.isoformat()
+        return data, confidence
+
+    if not hm:
+        # Creating or moving an event needs a time.
+        return None, 0.3
+
+    return {
+        "action": action,
+        "summary": summary,
+        "start_time": start_time,
+        "duration_minutes": duration or 60,
+        "color_id": color_id,
+    }, confidence
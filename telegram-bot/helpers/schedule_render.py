@@ -0,0 +1,25 @@
+from collections import Counter
+
+from helpers.colors import emoji_for_color
+
+DEFAULT_HEADLINE_EMOJI = "📅"
+
+
+def headline_emoji(color_ids) -> str:
+    """Emoji of the most common color category of the day."""
+    counts = Counter(str(c) for c in color_ids if c and emoji_for_color(c))
+    if not counts:
+        return DEFAULT_HEADLINE_EMOJI
+    color_id, _ = counts.most_common(1)[0]
+    return emoji_for_color(color_id)
+
+
+def render_schedule(date_str: str, event_lines, color_ids) -> str:
+    """Build the 'לו"ז ל[תאריך]' summary locally, without the LLM.
+
+    ``event_lines`` are the ready ``HH:MM-HH:MM - title emoji`` lines and
+    ``color_ids`` the colorId of each event (``None`` when unset).
+    """
+    headline = f'לו"ז ל{date_str} {headline_emoji(color_ids)}:'
+    bullets = "\n\n".join(f"- {line}" for line in event_lines)
+    return f"{headline}\n\n{bullets}"
@@ -0,0 +1,91 @@
+import os
+import asyncio
+import threading
+from contextlib import AsyncExitStack
+
+from metrics import count_tokens
+
+MODEL = "claude-haiku-4-5-20251001"
+
+# Upper bound on in-flight Anthropic requests across all users, and the
+# per-call deadline after which the user gets an error instead of waiting.
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 30))
+
+# Built on first use; importing anthropic alone takes over a second.
+ai_client = None
+_client_lock = threading.Lock()
+_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+
+def get_client():
+    """The shared AsyncAnthropic client, created on first call.
+
+    Safe to call from a worker thread, which is how startup pre-warms it
+    without blocking the event loop.
+    """
+    global ai_client
+    if ai_client is None:
+        with _client_lock:
+            if ai_client is None:
+                from anthropic import AsyncAnthropic
+
+                ai_client = AsyncAnthropic(max_retries=1)
+    return ai_client
+
+
+async def create_message(**kwargs):
+    """Run ``messages.create`` without blocking the event loop.
+
+    Calls are capped at ``LLM_CONCURRENCY`` concurrent requests and each one
+    is cancelled after ``LLM_TIMEOUT`` seconds (time spent queueing for a
+    slot counts towards the deadline).
+    """
+    kwargs.setdefault("model", MODEL)
+
+    async def _call():
+        async with _semaphore:
+            return await get_client().messages.create(**kwargs)
+
+    resp = await asyncio.wait_for(_call(), timeout=LLM_TIMEOUT)
+    count_tokens(resp.usage)
+    return resp
+
+
+async def complete_text(**kwargs) -> str:
+    """Return the text of the first content block of a completion."""
+    resp = await create_message(**kwargs)
+    return resp.content[0].text
+
+
+async def stream_text(**kwargs):
+    """Yield text deltas of a streamed completion.
+
+    Holds a concurrency slot for the whole stream; the ``LLM_TIMEOUT``
+    deadline covers the full generation. It only applies while waiting on
+    Anthropic: no timeout scope is held across a ``yield``, so time the
+    consumer spends between chunks is not cut short by a cancellation.
+    """
+    kwargs.setdefault("model", MODEL)
+    deadline = asyncio.get_running_loop().time() + LLM_TIMEOUT
+    async with asyncio.timeout_at(deadline):
+        await _semaphore.acquire()
+    try:
+        async with AsyncExitStack() as stack:
+            async with asyncio.timeout_at(deadline):
+                stream = await stack.enter_async_context(
+                    get_client().messages.stream(**kwargs)
+                )
+            chunks = aiter(stream.text_stream)
+            while True:
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        text = await anext(chunks)
+                except StopAsyncIteration:
+                    break
+                yield text
+            async with asyncio.timeout_at(deadline):
+                final = await stream.get_final_message()
+            count_tokens(final.usage)
+    finally:
+        _semaphore.release()
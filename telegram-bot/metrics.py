@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import secrets
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiohttp.web as web
+from telegram.request import HTTPXRequest
+
+# "json" prints one JSON object per log line; "text" keeps plain lines.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Metrics are kept per process: with SHARD_WORKERS the poll metrics of the
+# worker processes are not part of /metrics.
+
+# The update or poll the current task is working on, and the time it has
+# spent in each stage so far.
+request_id: ContextVar = ContextVar("request_id", default=None)
+_stages: ContextVar = ContextVar("stages", default=None)
+
+_registry: list = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values: dict = {}
+        # Calendar calls finish on worker threads; keep updates atomic.
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value) -> list:
+        return [f"{self.name}{_labels(self.label_names, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count.
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key, value) -> list:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            le = _labels(self.label_names, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        inf = _labels(self.label_names, key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{inf} {count}")
+        labels = _labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "xo_stage_seconds", "Time spent per request stage.", ["stage"]
+)
+REQUEST_SECONDS = Histogram(
+    "xo_request_seconds", "End-to-end handling time of a request.", ["kind"]
+)
+LLM_TOKENS = Counter(
+    "xo_anthropic_tokens_total", "Anthropic tokens by kind.", ["kind"]
+)
+CALENDAR_CALLS = Counter(
+    "xo_calendar_calls_total", "Google Calendar API calls by method.", ["method"]
+)
+CALENDAR_ERRORS = Counter(
+    "xo_calendar_errors_total", "Failed Google Calendar API calls.", ["method", "status"]
+)
+TELEGRAM_CALLS = Counter(
+    "xo_telegram_calls_total", "Telegram Bot API calls by method.", ["method"]
+)
+POLL_SECONDS = Histogram(
+    "xo_poll_duration_seconds", "Duration of a full event poll tick."
+)
+POLL_LAG = Gauge(
+    "xo_poll_lag_seconds", "How much later than its interval the last poll tick started."
+)
+INTENT_CACHE_LOOKUPS = Counter(
+    "xo_intent_cache_lookups_total", "LLM intent cache lookups by result.", ["result"]
+)
+NOTIFICATIONS = Counter(
+    "xo_notifications_total", "Outgoing notifications by result.", ["result"]
+)
+
+
+def log(event: str, **fields) -> None:
+    """Print one structured log line tagged with the current request ID."""
+    rid = request_id.get()
+    if LOG_FORMAT != "json":
+        extra = " ".join(f"{key}={value}" for key, value in fields.items())
+        print(f"[{rid or '-'}] {event} {extra}".rstrip())
+        return
+    record = {"ts": round(time.time(), 3), "event": event, "request_id": rid, **fields}
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(stage: str):
+    """Time a stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        stages = _stages.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def request_scope(kind: str, **fields):
+    """Run a request under a fresh request ID.
+
+    On exit one log line reports the total time and the time per stage.
+    """
+    rid = f"{kind}-{secrets.token_hex(4)}"
+    stages: dict = {}
+    id_token = request_id.set(rid)
+    stages_token = _stages.set(stages)
+    start = time.perf_counter()
+    try:
+        yield rid
+    finally:
+        elapsed = time.perf_counter() - start
+        REQUEST_SECONDS.observe(elapsed, kind=kind)
+        log(
+            f"{kind}_done",
+            **fields,
+            total_ms=round(elapsed * 1000, 1),
+            stages_ms={stage: round(t * 1000, 1) for stage, t in stages.items()},
+        )
+        _stages.reset(stages_token)
+        request_id.reset(id_token)
+
+
+def count_tokens(usage) -> None:
+    """Add an Anthropic ``usage`` block to the token counters."""
+    if usage is None:
+        return
+    for kind in ("input", "output", "cache_read_input", "cache_creation_input"):
+        value = getattr(usage, f"{kind}_tokens", None)
+        if value:
+            LLM_TOKENS.inc(value, kind=kind)
+
+
+class TimedRequest(HTTPXRequest):
+    """Counts and times Bot API calls.
+
+    Only used for the bot's regular requests; getUpdates long-polls on its
+    own request object and would swamp the timings.
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        TELEGRAM_CALLS.inc(method=api_method)
+        with span("telegram_send"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Prometheus text exposition of all metrics."""
+    return web.Response(
+        body=render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
@@ -0,0 +1,151 @@
+import os
+import asyncio
+from collections import deque
+
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+
+from helpers.token_bucket import TokenBucket
+from metrics import NOTIFICATIONS, log
+
+# Telegram allows about 30 messages per second per bot across all chats and
+# about one per second in a single chat (short bursts are tolerated).
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", 10000))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+OUTBOX_RETRY_BACKOFF = float(os.getenv("OUTBOX_RETRY_BACKOFF", 1.0))
+# How long shutdown waits for queued messages to go out.
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", 5))
+
+
+class Outbox:
+    """Rate-limited delivery of outgoing Telegram messages.
+
+    :meth:`send` only queues, so pollers never wait on Telegram. Workers
+    deliver each chat's messages in order, serve chats round-robin, and
+    stay under a per-chat and a global token bucket. A RetryAfter pauses the
+    chat for the time Telegram asks; network errors are retried with
+    backoff, up to ``OUTBOX_MAX_ATTEMPTS`` attempts.
+    """
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE)
+        self._buckets: dict = {}
+        self._pending: dict = {}
+        self._size = 0
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._workers: list = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, chat_id: int, text: str) -> bool:
+        """Queue ``text`` for ``chat_id``; returns False if the outbox is full."""
+        if self._size >= OUTBOX_MAX_PENDING:
+            self.dropped += 1
+            NOTIFICATIONS.inc(result="dropped")
+            log("outbox_full", chat_id=chat_id)
+            return False
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        queue.append([text, 0])
+        self._size += 1
+        self._idle.clear()
+        return True
+
+    def pending(self) -> int:
+        return self._size
+
+    def start(self) -> None:
+        for i in range(OUTBOX_WORKERS):
+            self._workers.append(asyncio.create_task(self._work(), name=f"outbox-{i}"))
+
+    async def stop(self) -> None:
+        """Give queued messages a moment to go out, then stop the workers."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=OUTBOX_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log("outbox_stopped", undelivered=self._size)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(
+                TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST
+            )
+        return bucket
+
+    def _later(self, chat_id, delay: float) -> None:
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    async def _work(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            bucket = self._bucket(chat_id)
+            delay = bucket.delay()
+            if delay > 0:
+                # Not this chat's turn yet; serve other chats meanwhile.
+                self._later(chat_id, delay)
+                continue
+            await self._global.acquire()
+            bucket.take()
+            queue = self._pending[chat_id]
+            item = queue[0]
+            retry_in = await self._deliver(chat_id, item)
+            if retry_in is None:
+                queue.popleft()
+                self._size -= 1
+            if not queue:
+                del self._pending[chat_id]
+                if not self._size:
+                    self._idle.set()
+            elif retry_in:
+                self._later(chat_id, retry_in)
+            else:
+                # Back of the line, so one busy chat cannot hold up others.
+                self._ready.put_nowait(chat_id)
+
+    async def _deliver(self, chat_id, item) -> float | None:
+        """Send one message; returns seconds until a retry, or None when done."""
+        text, attempts = item
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text)
+            self.sent += 1
+            NOTIFICATIONS.inc(result="sent")
+            return None
+        except RetryAfter as e:
+            retry_after = float(e.retry_after)
+            self._bucket(chat_id).pause(retry_after)
+            return retry_after
+        except (Forbidden, BadRequest) as e:
+            # The user blocked the bot or the chat is gone; retrying is useless.
+            log("message_dropped", chat_id=chat_id, error=repr(e))
+        except TelegramError as e:
+            item[1] = attempts = attempts + 1
+            if attempts < OUTBOX_MAX_ATTEMPTS:
+                return OUTBOX_RETRY_BACKOFF * 2 ** (attempts - 1)
+            log("message_given_up", chat_id=chat_id, error=repr(e))
+        except Exception as e:
+            log("message_send_failed", chat_id=chat_id, error=repr(e))
+        self.dropped += 1
+        NOTIFICATIONS.inc(result="dropped")
+        return None
+
+
+def outbox_notifier(outbox: Outbox):
+    """``notify(chat_id, text)`` callable for the poller that never blocks."""
+
+    async def notify(chat_id, text):
+        outbox.send(chat_id, text)
+
+    return notify
@@ -0,0 +1,94 @@
+import os
+import zlib
+import math
+import time
+import socket
+import hashlib
+import secrets
+
+# Unique per running process; leases taken by a crashed instance simply
+# expire after LEASE_TTL.
+INSTANCE_ID = os.getenv("INSTANCE_ID") or (
+    f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+)
+# Users are split into this many shards; each shard is polled by exactly one
+# instance at a time. With 1 (the default) the lease just elects a leader.
+POLL_SHARDS = int(os.getenv("POLL_SHARDS", 1))
+LEASE_TTL = float(os.getenv("LEASE_TTL", 30))
+LEASE_RENEW_INTERVAL = LEASE_TTL / 3
+
+MEMBER_PREFIX = "member:"
+SHARD_PREFIX = "poller:"
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def _weight(instance_id: str, shard: int) -> bytes:
+    return hashlib.md5(f"{instance_id}:{shard}".encode()).digest()
+
+
+class PollLeases:
+    """Which shards of users this instance may poll.
+
+    Every instance keeps a membership lease alive and claims up to its fair
+    share (shards / live instances) of shard leases, preferring the shards
+    rendezvous hashing assigns to it so ownership settles without
+    coordination. Instances above their share hand shards back, so a new
+    instance picks up work within a few renewals.
+    """
+
+    def __init__(self, store, instance_id: str = INSTANCE_ID, shards: int = POLL_SHARDS):
+        self._store = store
+        self.instance_id = instance_id
+        self.shards = max(1, shards)
+        # shard -> monotonic time after which we stop trusting our lease
+        self._owned: dict = {}
+
+    def shard_of(self, user_id: int) -> int:
+        return shard_of(user_id, self.shards)
+
+    def owns(self, user_id: int) -> bool:
+        deadline = self._owned.get(self.shard_of(user_id))
+        return deadline is not None and deadline > time.monotonic()
+
+    def owned_shards(self) -> set:
+        now = time.monotonic()
+        return {shard for shard, deadline in self._owned.items() if deadline > now}
+
+    def renew(self) -> set:
+        """Renew and rebalance the leases; returns shards newly acquired."""
+        store = self._store
+        # Stop trusting a lease a little before it can expire elsewhere.
+        deadline = time.monotonic() + LEASE_TTL - LEASE_RENEW_INTERVAL
+        store.acquire_lease(MEMBER_PREFIX + self.instance_id, self.instance_id, LEASE_TTL)
+        members = set(store.live_leases(MEMBER_PREFIX).values()) | {self.instance_id}
+        quota = math.ceil(self.shards / len(members))
+
+        def preferred(shard):
+            return max(members, key=lambda member: _weight(member, shard)) == self.instance_id
+
+        order = sorted(
+            range(self.shards),
+            key=lambda shard: (shard not in self._owned, not preferred(shard), shard),
+        )
+        owned, gained = {}, set()
+        for shard in order:
+            name = f"{SHARD_PREFIX}{shard}"
+            if len(owned) >= quota:
+                if shard in self._owned:
+                    store.release_lease(name, self.instance_id)
+                continue
+            if store.acquire_lease(name, self.instance_id, LEASE_TTL):
+                owned[shard] = deadline
+                if shard not in self.owned_shards():
+                    gained.add(shard)
+        self._owned = owned
+        return gained
+
+    def release_all(self) -> None:
+        for shard in self._owned:
+            self._store.release_lease(f"{SHARD_PREFIX}{shard}", self.instance_id)
+        self._store.release_lease(MEMBER_PREFIX + self.instance_id, self.instance_id)
+        self._owned = {}
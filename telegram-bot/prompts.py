@@ -0,0 +1,83 @@
+import os
+import time
+from pathlib import Path
+
+from metrics import log
+
+BASE_DIR = Path(__file__).resolve().parent
+
+PROMPT_FILES = {
+    "intent": "xo_assistance_prompt.txt",
+    "summary": "summarize_schedule_prompt.txt",
+}
+# Text each template must contain to be usable.
+REQUIRED_MARKERS = {
+    "intent": ('"action"', "JSON"),
+    "summary": ("[תאריך]",),
+}
+
+# Re-read a prompt file when its mtime changes (checked at most every
+# PROMPT_RELOAD_INTERVAL seconds). Off by default: prompts are read once.
+PROMPT_HOT_RELOAD = os.getenv("PROMPT_HOT_RELOAD", "0") == "1"
+PROMPT_RELOAD_INTERVAL = float(os.getenv("PROMPT_RELOAD_INTERVAL", 5))
+
+_prompts: dict = {}
+_mtimes: dict = {}
+_last_check = 0.0
+
+
+def _read_prompt(name: str) -> str:
+    path = BASE_DIR / PROMPT_FILES[name]
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    missing = [marker for marker in REQUIRED_MARKERS[name] if marker not in text]
+    if not text.strip() or missing:
+        raise ValueError(f"Prompt {path.name} is invalid, missing: {missing or 'text'}")
+    _mtimes[name] = path.stat().st_mtime
+    return text
+
+
+def load_prompts() -> None:
+    """Read and validate every prompt template; raises on a broken file."""
+    for name in PROMPT_FILES:
+        _prompts[name] = _read_prompt(name)
+
+
+def _reload_changed() -> None:
+    global _last_check
+    now = time.monotonic()
+    if now - _last_check < PROMPT_RELOAD_INTERVAL:
+        return
+    _last_check = now
+    for name, filename in PROMPT_FILES.items():
+        try:
+            if (BASE_DIR / filename).stat().st_mtime == _mtimes.get(name):
+                continue
+            _prompts[name] = _read_prompt(name)
+            log("prompt_reloaded", filename=filename)
+        except (OSError, ValueError) as e:
+            # Keep serving the last good version.
+            log("prompt_reload_failed", filename=filename, error=repr(e))
+
+
+def get_prompt(name: str) -> str:
+    if not _prompts:
+        load_prompts()
+    elif PROMPT_HOT_RELOAD:
+        _reload_changed()
+    return _prompts[name]
+
+
+def cached_system(name: str) -> list:
+    """System blocks for ``name`` with a prompt-caching breakpoint.
+
+    The template is static, so marking it ephemeral lets consecutive calls
+    reuse the cached prefix instead of paying for it again.
+    """
+    return [
+        {
+            "type": "text",
+            "text": get_prompt(name),
+            "cache_control": {"type": "ephemeral"},
+        }
+    ]
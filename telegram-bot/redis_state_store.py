@@ -0,0 +1,236 @@
+import os
+import json
+import time
+
+from state_store import LAST_SEEN_RESOLUTION, PENDING_AUTH_TTL
+
+# Any server speaking the Redis protocol (Redis, Valkey, KeyDB, ...).
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Prefix for every key, so several deployments can share one server.
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "xo:")
+
+INT_COLUMNS = {"chat_id"}
+FLOAT_COLUMNS = {"last_seen"}
+
+
+class RedisStateStore:
+    """Same interface as :class:`state_store.StateStore`, kept in Redis.
+
+    Used when bot instances run on several hosts. Nothing is cached in
+    memory, so every instance sees every write immediately. ``client`` can
+    be any redis-py compatible client, e.g. a local stand-in for tests.
+    """
+
+    def __init__(self, client=None, prefix: str = REDIS_PREFIX):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("STATE_BACKEND=redis needs the 'redis' package") from e
+            client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        self._redis = client
+        self._prefix = prefix
+
+    def _key(self, *parts) -> str:
+        return self._prefix + ":".join(str(part) for part in parts)
+
+    # Approved users
+
+    def approved_users(self) -> set:
+        return {int(uid) for uid in self._redis.smembers(self._key("approved"))}
+
+    def is_approved(self, user_id: int) -> bool:
+        return bool(self._redis.sismember(self._key("approved"), user_id))
+
+    def add_approved_user(self, user_id: int) -> None:
+        self._redis.sadd(self._key("approved"), user_id)
+
+    def recently_active_users(self) -> list:
+        """Approved users, the most recently active first."""
+        users = list(self.approved_users())
+        with self._redis.pipeline() as pipe:
+            for user_id in users:
+                pipe.hget(self._key("user", user_id), "last_seen")
+            seen = pipe.execute()
+        last_seen = {u: float(s or 0) for u, s in zip(users, seen)}
+        return sorted(users, key=last_seen.get, reverse=True)
+
+    # Per-user values
+
+    def _user_field(self, user_id: int, column: str):
+        value = self._redis.hget(self._key("user", user_id), column)
+        if value is not None and column in INT_COLUMNS:
+            return int(value)
+        if value is not None and column in FLOAT_COLUMNS:
+            return float(value)
+        return value
+
+    def _set_user_field(self, user_id: int, column: str, value) -> None:
+        if value is None:
+            self._redis.hdel(self._key("user", user_id), column)
+        else:
+            self._redis.hset(self._key("user", user_id), column, value)
+
+    def get_chat_id(self, user_id: int) -> int | None:
+        return self._user_field(user_id, "chat_id")
+
+    def set_chat_id(self, user_id: int, chat_id: int) -> None:
+        self._set_user_field(user_id, "chat_id", chat_id)
+
+    def touch_user(self, user_id: int) -> None:
+        """Note that ``user_id`` is active, see ``LAST_SEEN_RESOLUTION``."""
+        now = time.time()
+        last_seen = self._user_field(user_id, "last_seen")
+        if last_seen is None or now - last_seen >= LAST_SEEN_RESOLUTION:
+            self._set_user_field(user_id, "last_seen", now)
+
+    def get_calendar_id(self, user_id: int) -> str | None:
+        return self._user_field(user_id, "calendar_id")
+
+    def set_calendar_id(self, user_id: int, calendar_id: str) -> None:
+        self._set_user_field(user_id, "calendar_id", calendar_id)
+
+    def get_token(self, user_id: int) -> str | None:
+        return self._user_field(user_id, "token")
+
+    def set_token(self, user_id: int, token: str | None) -> None:
+        self._set_user_field(user_id, "token", token)
+
+    def delete_token(self, user_id: int) -> None:
+        self.set_token(user_id, None)
+
+    def get_summary_mode(self, user_id: int) -> str | None:
+        return self._user_field(user_id, "summary_mode")
+
+    def set_summary_mode(self, user_id: int, mode: str | None) -> None:
+        self._set_user_field(user_id, "summary_mode", mode)
+
+    # OAuth flows in progress
+
+    def set_pending_auth(self, user_id: int, chat_id: int, flow: dict | None = None) -> None:
+        self._redis.set(
+            self._key("pending_auth", user_id),
+            json.dumps({"chat_id": chat_id, "flow": flow}),
+            ex=PENDING_AUTH_TTL,
+        )
+
+    def pop_pending_auth(self, user_id: int):
+        """Remove the pending flow for ``user_id`` and return ``(chat_id, flow)``."""
+        key = self._key("pending_auth", user_id)
+        with self._redis.pipeline() as pipe:
+            pipe.get(key)
+            pipe.delete(key)
+            raw, _ = pipe.execute()
+        if not raw:
+            return None, None
+        data = json.loads(raw)
+        return data.get("chat_id"), data.get("flow")
+
+    # Tracked events
+
+    def load_tracked(self, user_id: int, calendar_id: str) -> dict:
+        rows = self._redis.hgetall(self._key("tracked", user_id, calendar_id))
+        return {event_id: json.loads(info) for event_id, info in rows.items()}
+
+    def save_tracked(
+        self, user_id: int, calendar_id: str, changed: dict, removed=()
+    ) -> None:
+        """Write the ``changed`` rows of one calendar and delete ``removed`` ids."""
+        upserts = {event_id: json.dumps(info) for event_id, info in changed.items()}
+        removed = list(removed)
+        redis_key = self._key("tracked", user_id, calendar_id)
+        with self._redis.pipeline() as pipe:
+            if upserts:
+                pipe.hset(redis_key, mapping=upserts)
+            if removed:
+                pipe.hdel(redis_key, *removed)
+            pipe.sadd(self._key("tracked_calendars", user_id), calendar_id)
+            pipe.execute()
+
+    def clear_tracked(self, user_id: int) -> None:
+        """Forget tracked events of every calendar of ``user_id``."""
+        calendars_key = self._key("tracked_calendars", user_id)
+        calendars = self._redis.smembers(calendars_key)
+        self._redis.delete(
+            calendars_key, *(self._key("tracked", user_id, cal) for cal in calendars)
+        )
+
+    # Leases
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or extend ``name`` for ``ttl`` seconds unless someone else holds it."""
+        key = self._key("lease", name)
+        ttl_ms = int(ttl * 1000)
+        if self._redis.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != owner:
+                    return False
+                pipe.multi()
+                pipe.pexpire(key, ttl_ms)
+                pipe.execute()
+                return True
+            except self._watch_error():
+                return False
+
+    def release_lease(self, name: str, owner: str) -> None:
+        key = self._key("lease", name)
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) == owner:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+            except self._watch_error():
+                pass
+
+    def live_leases(self, prefix: str) -> dict:
+        """Unexpired leases whose name starts with ``prefix``: name -> owner."""
+        base = self._key("lease", "")
+        keys = list(self._redis.scan_iter(match=base + prefix + "*"))
+        if not keys:
+            return {}
+        owners = self._redis.mget(keys)
+        return {
+            key[len(base):]: owner for key, owner in zip(keys, owners) if owner is not None
+        }
+
+    # Watch channels
+
+    def load_channels(self, address: str) -> dict:
+        """Unexpired channels delivering to ``address``: channel_id -> info."""
+        now = time.time()
+        channels, expired = {}, []
+        for channel_id, info in self._redis.hgetall(self._key("channels", address)).items():
+            channel = json.loads(info)
+            if channel["expiration"] > now:
+                channels[channel_id] = channel
+            else:
+                expired.append(channel_id)
+        if expired:
+            self._redis.hdel(self._key("channels", address), *expired)
+            self._redis.hdel(self._key("channel_address"), *expired)
+        return channels
+
+    def save_channel(self, channel_id: str, address: str, channel: dict) -> None:
+        with self._redis.pipeline() as pipe:
+            pipe.hset(self._key("channels", address), channel_id, json.dumps(channel))
+            pipe.hset(self._key("channel_address"), channel_id, address)
+            pipe.execute()
+
+    def delete_channel(self, channel_id: str) -> None:
+        address = self._redis.hget(self._key("channel_address"), channel_id)
+        if address is not None:
+            with self._redis.pipeline() as pipe:
+                pipe.hdel(self._key("channels", address), channel_id)
+                pipe.hdel(self._key("channel_address"), channel_id)
+                pipe.execute()
+
+    @staticmethod
+    def _watch_error():
+        from redis.exceptions import WatchError
+
+        return WatchError
@@ -0,0 +1,155 @@
+import os
+import heapq
+import asyncio
+import itertools
+import time
+import traceback
+
+from event_watcher import render_message
+from helpers.colors import reminder_minutes
+from metrics import log
+from tracked_events import local_strings
+
+# Lead times per event color are in helpers/colors.py.
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "1") == "1"
+
+
+class ReminderScheduler:
+    """Fires "starting soon" reminders from the poller's event data.
+
+    The poll diff tells the scheduler about new, moved and removed events
+    (:meth:`event_changed`); a full listing seeds a user the first time
+    (:meth:`replace`). Fire times sit in one min-heap across users and a
+    single timer is armed for the earliest, on the PTB ``job_queue`` when
+    one is given and on the asyncio loop otherwise (poll workers have no
+    job queue). Superseded heap entries are skipped when they come up, so
+    rescheduling is O(log n) and firing makes no Calendar calls.
+
+    ``notify`` is the usual ``async (chat_id, text)`` callable and ``owns``
+    tells whether this process still polls a user; reminders of users it
+    no longer polls are dropped, since their new poller has its own.
+    """
+
+    def __init__(self, notify, job_queue=None, owns=None):
+        self._notify = notify
+        self._job_queue = job_queue
+        self._owns = owns or (lambda user_id: True)
+        self._heap: list = []
+        self._seq = itertools.count()
+        # user_id -> {"calendar", "chat_id", "entries": {event_id: (seq, start, summary)},
+        #             "fired": {event_id: start}}
+        self._users: dict = {}
+        self._timer = None
+        self._armed_at = None
+
+    def watching(self, user_id: int, calendar_id: str) -> bool:
+        user = self._users.get(user_id)
+        return user is not None and user["calendar"] == calendar_id
+
+    def replace(self, user_id: int, chat_id: int, calendar_id: str, events, bounds) -> None:
+        """Schedule every event of a fresh listing, dropping earlier state.
+
+        Reminders already due are skipped: after a restart they may have
+        been sent before.
+        """
+        self._users[user_id] = {
+            "calendar": calendar_id, "chat_id": chat_id, "entries": {}, "fired": {},
+        }
+        now = time.time()
+        for event in events:
+            times = bounds(event)
+            if times is not None:
+                self._schedule(user_id, event, times[0], now, catch_up=False)
+        self._arm()
+
+    def event_changed(self, user_id: int, event_id: str, record, event) -> None:
+        """Diff callback: ``record`` is the new state, ``None`` once it is gone."""
+        user = self._users.get(user_id)
+        if user is None:
+            return
+        if record is None:
+            # The heap entry goes stale and is skipped when it comes up.
+            user["entries"].pop(event_id, None)
+            user["fired"].pop(event_id, None)
+            return
+        self._schedule(user_id, event, record.start, time.time(), catch_up=True)
+        self._arm()
+
+    def forget(self, predicate) -> None:
+        """Drop the reminders of users matching ``predicate``."""
+        for user_id in [u for u in self._users if predicate(u)]:
+            del self._users[user_id]
+
+    def stop(self) -> None:
+        self._disarm()
+
+    def _schedule(self, user_id, event, start: float, now: float, catch_up: bool) -> None:
+        user = self._users[user_id]
+        event_id = event["id"]
+        user["entries"].pop(event_id, None)
+        lead = reminder_minutes(event.get("colorId"))
+        if not lead or not event.get("start", {}).get("dateTime") or start <= now:
+            return
+        if user["fired"].get(event_id) == start:
+            return
+        fire_at = start - lead * 60
+        if fire_at <= now and not catch_up:
+            return
+        seq = next(self._seq)
+        user["entries"][event_id] = (seq, start, event.get("summary", "ללא כותרת"))
+        heapq.heappush(self._heap, (fire_at, seq, user_id, event_id))
+
+    def _arm(self) -> None:
+        """Make sure the timer goes off for the earliest entry."""
+        if not self._heap:
+            return
+        fire_at = self._heap[0][0]
+        if self._timer is not None and self._armed_at <= fire_at:
+            return
+        self._disarm()
+        delay = max(0.0, fire_at - time.time())
+        if self._job_queue is not None:
+            self._timer = self._job_queue.run_once(self._job, when=delay, name="reminders")
+        else:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(delay, lambda: asyncio.ensure_future(self._fire()))
+        self._armed_at = fire_at
+
+    def _disarm(self) -> None:
+        if self._timer is not None:
+            if self._job_queue is not None:
+                self._timer.schedule_removal()
+            else:
+                self._timer.cancel()
+        self._timer = None
+        self._armed_at = None
+
+    async def _job(self, context) -> None:
+        await self._fire()
+
+    async def _fire(self) -> None:
+        self._timer = None
+        self._armed_at = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, user_id, event_id = heapq.heappop(self._heap)
+            user = self._users.get(user_id)
+            entry = user["entries"].get(event_id) if user else None
+            if entry is None or entry[0] != seq:
+                continue
+            del user["entries"][event_id]
+            _, start, summary = entry
+            user["fired"][event_id] = start
+            if not self._owns(user_id):
+                continue
+            start_time, _ = local_strings(start)
+            minutes = max(1, round((start - now) / 60))
+            text = render_message(
+                "event_reminder", summary=summary, minutes=minutes, time=start_time
+            )
+            try:
+                await self._notify(user["chat_id"], text)
+            except Exception as e:
+                log("reminder_failed", user_id=user_id, error=repr(e))
+                traceback.print_exc()
+        self._arm()
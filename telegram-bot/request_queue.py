@@ -0,0 +1,101 @@
+import os
+import time
+import asyncio
+import traceback
+from collections import deque
+
+from metrics import log
+
+# Messages waiting per user beyond the one being handled; more than this and
+# the user gets a "busy" reply instead.
+USER_QUEUE_DEPTH = int(os.getenv("USER_QUEUE_DEPTH", 5))
+# Workers shared by all users; each handles one user's message at a time.
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", 32))
+# A message that may be merged waits this many seconds for follow-ups; queued
+# messages sent less than this apart are handled as one.
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 1))
+
+
+class RequestQueue:
+    """Per-user FIFO queues served round-robin by a fixed pool of workers.
+
+    A user's messages are handled strictly one after another, and a user
+    with a backlog goes to the back of the line after each message so one
+    busy chat cannot starve the others. A user whose next message may be
+    merged is only picked up once it is ``COALESCE_WINDOW`` old; the queued
+    messages of the burst are then merged into a single call of
+    ``handler(update, context, text, coalesced)``.
+    ``can_coalesce(update, context)`` decides which messages may be merged.
+    """
+
+    def __init__(self, handler, can_coalesce=None):
+        self._handler = handler
+        self._can_coalesce = can_coalesce or (lambda update, context: False)
+        self._queues: dict = {}
+        self._scheduled: set = set()
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._workers: list = []
+
+    def submit(self, user_id, update, context) -> bool:
+        """Queue a message; returns False if the user's queue is full."""
+        queue = self._queues.setdefault(user_id, deque())
+        if len(queue) >= USER_QUEUE_DEPTH:
+            return False
+        queue.append((time.monotonic(), update, context))
+        if user_id not in self._scheduled:
+            self._scheduled.add(user_id)
+            self._schedule(user_id, queue)
+        return True
+
+    def _schedule(self, user_id, queue: deque) -> None:
+        """Hand the user to a worker once their next message has waited out the window."""
+        received, update, context = queue[0]
+        delay = received + COALESCE_WINDOW - time.monotonic()
+        if delay > 0 and self._can_coalesce(update, context):
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, user_id)
+        else:
+            self._ready.put_nowait(user_id)
+
+    def pending(self, user_id) -> int:
+        return len(self._queues.get(user_id, ()))
+
+    def start(self) -> None:
+        for i in range(QUEUE_WORKERS):
+            self._workers.append(asyncio.create_task(self._work(), name=f"request-worker-{i}"))
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def _take(self, queue: deque):
+        received, update, context = queue.popleft()
+        texts = [update.effective_message.text]
+        if self._can_coalesce(update, context):
+            while queue and queue[0][0] - received <= COALESCE_WINDOW:
+                received, next_update, next_context = queue[0]
+                if not self._can_coalesce(next_update, next_context):
+                    break
+                queue.popleft()
+                update, context = next_update, next_context
+                texts.append(update.effective_message.text)
+        # Reply to the latest message of the burst.
+        return update, context, "\n".join(texts), len(texts) > 1
+
+    async def _work(self) -> None:
+        while True:
+            user_id = await self._ready.get()
+            queue = self._queues[user_id]
+            try:
+                update, context, text, coalesced = self._take(queue)
+                await self._handler(update, context, text, coalesced)
+            except Exception as e:
+                log("queued_message_failed", user_id=user_id, error=repr(e))
+                traceback.print_exc()
+            finally:
+                if queue:
+                    self._schedule(user_id, queue)
+                else:
+                    self._scheduled.discard(user_id)
+                    del self._queues[user_id]
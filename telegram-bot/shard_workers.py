@@ -0,0 +1,151 @@
+import os
+import time
+import queue
+import asyncio
+import traceback
+import multiprocessing as mp
+
+from event_watcher import POLL_INTERVAL, forget_users, poll_and_notify, poll_users
+from helpers.hash_ring import HashRing
+from metrics import log
+from poll_leases import LEASE_RENEW_INTERVAL, LEASE_TTL, shard_of
+from reminders import REMINDERS_ENABLED, ReminderScheduler
+from state_store import get_store
+
+# Number of poller processes; 0 (the default) polls inside the bot process.
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", 0))
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", 10))
+
+
+class ShardWorkers:
+    """Poll users from ``count`` worker processes.
+
+    Users are spread over the workers by consistent hashing. Each worker
+    runs the usual poll and diff loop over its users, limited to the lease
+    shards this instance holds. Alerts come back over one queue and are
+    handed to the bot process's outbox, which paces them under Telegram's
+    limits.
+    """
+
+    def __init__(self, count: int, lease_shards: int):
+        ctx = mp.get_context("spawn")
+        self.count = count
+        self._ring = HashRing(range(count))
+        self._alerts = ctx.Queue()
+        self._inboxes = [ctx.Queue() for _ in range(count)]
+        # Wall-clock deadline of each lease shard we hold, 0 when not held.
+        self._lease_deadlines = ctx.Array("d", lease_shards)
+        self._stop = ctx.Event()
+        self._processes = [
+            ctx.Process(
+                target=worker_main,
+                args=(i, count, self._lease_deadlines, self._inboxes[i], self._alerts, self._stop),
+                name=f"poll-worker-{i}",
+                daemon=True,
+            )
+            for i in range(count)
+        ]
+        self._sender = None
+
+    def worker_for(self, user_id: int) -> int:
+        return self._ring.node_for(user_id)
+
+    def publish_leases(self, leases) -> None:
+        owned = leases.owned_shards()
+        deadline = time.time() + LEASE_TTL - LEASE_RENEW_INTERVAL
+        for shard in range(len(self._lease_deadlines)):
+            self._lease_deadlines[shard] = deadline if shard in owned else 0.0
+
+    def refresh(self, user_id: int) -> None:
+        """Ask the worker owning ``user_id`` to poll them right away."""
+        self._inboxes[self.worker_for(user_id)].put(user_id)
+
+    def start(self, outbox) -> None:
+        for process in self._processes:
+            process.start()
+        self._sender = asyncio.create_task(self._forward_alerts(outbox))
+        log("poll_workers_started", count=self.count)
+
+    async def stop(self) -> None:
+        self._stop.set()
+        self._alerts.put(None)
+        if self._sender:
+            await self._sender
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+    async def _forward_alerts(self, outbox) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self._alerts.get)
+            if item is None:
+                return
+            chat_id, text = item
+            outbox.send(chat_id, text)
+
+
+def worker_main(index, count, lease_deadlines, inbox, alerts, stop) -> None:
+    """Entry point of a poll worker process."""
+    try:
+        asyncio.run(_worker_loop(index, count, lease_deadlines, inbox, alerts, stop))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_loop(index, count, lease_deadlines, inbox, alerts, stop) -> None:
+    ring = HashRing(range(count))
+    shards = len(lease_deadlines)
+    store = get_store()
+    # Same shape as the bot's bot_data; push channel state stays in the bot
+    # process, so watched users are polled every interval here.
+    bot_data: dict = {}
+    owned: set = set()
+    owned_before: set = set()
+    tick = None
+    # Like the in-process job, give the first lease renewal time to land.
+    next_tick = time.monotonic() + 10
+
+    async def notify(chat_id, text):
+        alerts.put((chat_id, text))
+
+    def mine(user_id, owned) -> bool:
+        return ring.node_for(user_id) == index and shard_of(user_id, shards) in owned
+
+    if REMINDERS_ENABLED:
+        # No job queue here; the scheduler times itself on this loop.
+        bot_data["reminders"] = ReminderScheduler(notify, owns=lambda u: mine(u, owned))
+
+    while not stop.is_set():
+        now = time.time()
+        owned = {shard for shard in range(shards) if lease_deadlines[shard] > now}
+        gained = owned - owned_before
+        owned_before = owned
+        if gained:
+            forget_users(bot_data, lambda u: shard_of(u, shards) in gained)
+
+        if time.monotonic() >= next_tick and (tick is None or tick.done()):
+            next_tick = max(next_tick + POLL_INTERVAL, time.monotonic())
+            users = [u for u in store.approved_users() if mine(u, owned)]
+            tick = asyncio.create_task(poll_users(bot_data, users, notify))
+
+        while True:
+            try:
+                user_id = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if mine(user_id, owned):
+                try:
+                    await poll_and_notify(bot_data, notify, user_id)
+                except Exception as e:
+                    log("immediate_poll_failed", user_id=user_id, error=repr(e))
+                    traceback.print_exc()
+
+        await asyncio.sleep(min(1.0, max(0.1, next_tick - time.monotonic())))
+
+    if tick is not None and not tick.done():
+        tick.cancel()
+    if "reminders" in bot_data:
+        bot_data["reminders"].stop()
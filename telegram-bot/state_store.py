@@ -0,0 +1,429 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+TOKEN_DIR = BASE_DIR / "tokens"
+STATE_DB_PATH = Path(os.getenv("STATE_DB_PATH", TOKEN_DIR / "state.db"))
+# "sqlite" for one host (any number of processes sharing STATE_DB_PATH) or
+# "redis" for instances on several hosts, see redis_state_store.py.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+# OAuth links older than this are treated as expired.
+PENDING_AUTH_TTL = int(os.getenv("PENDING_AUTH_TTL", 3600))
+# How often the in-memory copies check whether another process wrote to the
+# database.
+STATE_SYNC_INTERVAL = float(os.getenv("STATE_SYNC_INTERVAL", 1.0))
+# A user's last activity is only rewritten once it is this many seconds old,
+# so busy chats do not write on every message.
+LAST_SEEN_RESOLUTION = float(os.getenv("LAST_SEEN_RESOLUTION", 3600))
+
+# Per-user columns mirrored in memory; new ones are added to existing
+# databases by ``_migrate``.
+USER_COLUMNS = {
+    "chat_id": "INTEGER",
+    "calendar_id": "TEXT",
+    "token": "TEXT",
+    "summary_mode": "TEXT",
+    "last_seen": "REAL",
+}
+ADDED_COLUMNS = {
+    "users": USER_COLUMNS,
+    "pending_auth": {"flow": "TEXT"},
+    "watch_channels": {"token": "TEXT"},
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS approved_users (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    calendar_id TEXT,
+    token TEXT,
+    summary_mode TEXT,
+    last_seen REAL
+);
+CREATE TABLE IF NOT EXISTS pending_auth (
+    user_id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    flow TEXT,
+    created_at REAL DEFAULT (strftime('%s', 'now'))
+);
+CREATE TABLE IF NOT EXISTS tracked_events (
+    user_id INTEGER NOT NULL,
+    calendar_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    updated TEXT,
+    summary TEXT,
+    start TEXT,
+    PRIMARY KEY (user_id, calendar_id, event_id)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watch_channels (
+    channel_id TEXT PRIMARY KEY,
+    address TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    calendar_id TEXT NOT NULL,
+    resource_id TEXT,
+    expiration REAL NOT NULL,
+    token TEXT
+);
+"""
+
+
+class StateStore:
+    """Transactional bot state in a single SQLite database (WAL mode).
+
+    Small per-user values (approval, chat, calendar, token, settings) are
+    read from an in-memory copy that every write updates together with the
+    database, so lookups on the message path never touch the disk. Several
+    processes may share the file; the copy is reloaded when another one
+    commits.
+    """
+
+    def __init__(self, path: Path = STATE_DB_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._import_legacy_files(path.parent)
+        self._load_memory()
+
+    def _migrate(self) -> None:
+        with self._lock, self._conn:
+            for table, columns in ADDED_COLUMNS.items():
+                existing = {
+                    row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")
+                }
+                for column, kind in columns.items():
+                    if column not in existing:
+                        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+    def _load_memory(self) -> None:
+        with self._lock:
+            self._approved = {
+                row[0] for row in self._conn.execute("SELECT user_id FROM approved_users")
+            }
+            columns = ", ".join(USER_COLUMNS)
+            self._users = {
+                row[0]: dict(zip(USER_COLUMNS, row[1:]))
+                for row in self._conn.execute(f"SELECT user_id, {columns} FROM users")
+            }
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            self._synced_at = time.monotonic()
+
+    def _sync_memory(self) -> None:
+        """Reload the in-memory copy if another process committed since."""
+        if time.monotonic() - self._synced_at < STATE_SYNC_INTERVAL:
+            return
+        with self._lock:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version != self._data_version:
+                self._load_memory()
+            else:
+                self._synced_at = time.monotonic()
+
+    def _import_legacy_files(self, token_dir: Path) -> None:
+        """One-time import of the JSON files used before the database."""
+        with self._lock, self._conn:
+            done = self._conn.execute(
+                "SELECT 1 FROM meta WHERE key = 'legacy_imported'"
+            ).fetchone()
+            if done:
+                return
+            approved_file = token_dir / "approved_users.json"
+            if approved_file.exists():
+                try:
+                    with open(approved_file, "r") as f:
+                        ids = json.load(f)
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO approved_users (user_id) VALUES (?)",
+                        [(int(uid),) for uid in ids],
+                    )
+                except (json.JSONDecodeError, OSError, ValueError):
+                    pass
+            for token_file in token_dir.glob("token_*.json"):
+                try:
+                    user_id = int(token_file.stem[len("token_"):])
+                    token = token_file.read_text()
+                except (ValueError, OSError):
+                    continue
+                self._upsert_user(user_id, "token", token)
+            for pref_file in token_dir.glob("calendar_*.json"):
+                try:
+                    user_id = int(pref_file.stem[len("calendar_"):])
+                    with open(pref_file, "r", encoding="utf-8") as f:
+                        calendar_id = json.load(f).get("calendar_id")
+                except (ValueError, OSError, AttributeError):
+                    continue
+                if isinstance(calendar_id, str) and calendar_id:
+                    self._upsert_user(user_id, "calendar_id", calendar_id)
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('legacy_imported', '1')"
+            )
+
+    def _upsert_user(self, user_id: int, column: str, value) -> None:
+        self._conn.execute(
+            f"INSERT INTO users (user_id, {column}) VALUES (?, ?) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {column} = excluded.{column}",
+            (user_id, value),
+        )
+
+    def _set_user_field(self, user_id: int, column: str, value) -> None:
+        with self._lock, self._conn:
+            self._upsert_user(user_id, column, value)
+            user = self._users.setdefault(user_id, dict.fromkeys(USER_COLUMNS))
+            user[column] = value
+
+    def _user_field(self, user_id: int, column: str):
+        self._sync_memory()
+        user = self._users.get(user_id)
+        return user[column] if user else None
+
+    # Approved users
+
+    def approved_users(self) -> set:
+        self._sync_memory()
+        return set(self._approved)
+
+    def is_approved(self, user_id: int) -> bool:
+        self._sync_memory()
+        return user_id in self._approved
+
+    def add_approved_user(self, user_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO approved_users (user_id) VALUES (?)",
+                (user_id,),
+            )
+            self._approved.add(user_id)
+
+    def recently_active_users(self) -> list:
+        """Approved users, the most recently active first."""
+        self._sync_memory()
+        return sorted(
+            self._approved,
+            key=lambda u: (self._users.get(u) or {}).get("last_seen") or 0,
+            reverse=True,
+        )
+
+    # Per-user values
+
+    def get_chat_id(self, user_id: int) -> int | None:
+        return self._user_field(user_id, "chat_id")
+
+    def set_chat_id(self, user_id: int, chat_id: int) -> None:
+        if self.get_chat_id(user_id) != chat_id:
+            self._set_user_field(user_id, "chat_id", chat_id)
+
+    def touch_user(self, user_id: int) -> None:
+        """Note that ``user_id`` is active, see ``LAST_SEEN_RESOLUTION``."""
+        now = time.time()
+        last_seen = self._user_field(user_id, "last_seen")
+        if last_seen is None or now - last_seen >= LAST_SEEN_RESOLUTION:
+            self._set_user_field(user_id, "last_seen", now)
+
+    def get_calendar_id(self, user_id: int) -> str | None:
+        return self._user_field(user_id, "calendar_id")
+
+    def set_calendar_id(self, user_id: int, calendar_id: str) -> None:
+        self._set_user_field(user_id, "calendar_id", calendar_id)
+
+    def get_token(self, user_id: int) -> str | None:
+        return self._user_field(user_id, "token")
+
+    def set_token(self, user_id: int, token: str | None) -> None:
+        self._set_user_field(user_id, "token", token)
+
+    def delete_token(self, user_id: int) -> None:
+        self.set_token(user_id, None)
+
+    def get_summary_mode(self, user_id: int) -> str | None:
+        return self._user_field(user_id, "summary_mode")
+
+    def set_summary_mode(self, user_id: int, mode: str | None) -> None:
+        self._set_user_field(user_id, "summary_mode", mode)
+
+    # OAuth flows in progress
+
+    def set_pending_auth(self, user_id: int, chat_id: int, flow: dict | None = None) -> None:
+        """Remember where to report the flow; ``flow`` is its serialized state."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_auth (user_id, chat_id, flow, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, chat_id, json.dumps(flow) if flow else None, time.time()),
+            )
+
+    def pop_pending_auth(self, user_id: int):
+        """Remove the pending flow for ``user_id``.
+
+        Returns ``(chat_id, flow)``; ``flow`` is ``None`` once the link expired.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT chat_id, flow, created_at FROM pending_auth WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+            self._conn.execute("DELETE FROM pending_auth WHERE user_id = ?", (user_id,))
+        if not row:
+            return None, None
+        chat_id, flow, created_at = row
+        if not flow or time.time() - (created_at or 0) > PENDING_AUTH_TTL:
+            return chat_id, None
+        return chat_id, json.loads(flow)
+
+    # Tracked events
+
+    def load_tracked(self, user_id: int, calendar_id: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT event_id, updated, summary, start FROM tracked_events "
+                "WHERE user_id = ? AND calendar_id = ?",
+                (user_id, calendar_id),
+            ).fetchall()
+        return {
+            event_id: {"updated": updated, "summary": summary, "start": start}
+            for event_id, updated, summary, start in rows
+        }
+
+    def save_tracked(
+        self, user_id: int, calendar_id: str, changed: dict, removed=()
+    ) -> None:
+        """Write the ``changed`` rows of one calendar and delete ``removed`` ids."""
+        upserts = [
+            (user_id, calendar_id, event_id, info["updated"], info["summary"], info["start"])
+            for event_id, info in changed.items()
+        ]
+        removed = [(user_id, calendar_id, event_id) for event_id in removed]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tracked_events "
+                "(user_id, calendar_id, event_id, updated, summary, start) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                upserts,
+            )
+            self._conn.executemany(
+                "DELETE FROM tracked_events "
+                "WHERE user_id = ? AND calendar_id = ? AND event_id = ?",
+                removed,
+            )
+
+    def clear_tracked(self, user_id: int) -> None:
+        """Forget tracked events of every calendar of ``user_id``."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tracked_events WHERE user_id = ?", (user_id,))
+
+    # Leases
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or extend ``name`` for ``ttl`` seconds unless someone else holds it."""
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, "
+                "expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now),
+            )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)
+            )
+
+    def live_leases(self, prefix: str) -> dict:
+        """Unexpired leases whose name starts with ``prefix``: name -> owner."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, owner FROM leases WHERE substr(name, 1, ?) = ? "
+                "AND expires_at >= ?",
+                (len(prefix), prefix, time.time()),
+            ).fetchall()
+        return dict(rows)
+
+    # Watch channels
+
+    def load_channels(self, address: str) -> dict:
+        """Unexpired channels delivering to ``address``: channel_id -> info."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT channel_id, user_id, calendar_id, resource_id, expiration, token "
+                "FROM watch_channels WHERE address = ? AND expiration > ?",
+                (address, time.time()),
+            ).fetchall()
+        return {
+            channel_id: {
+                "user_id": user_id,
+                "calendar_id": calendar_id,
+                "resource_id": resource_id,
+                "expiration": expiration,
+                "token": token,
+            }
+            for channel_id, user_id, calendar_id, resource_id, expiration, token in rows
+        }
+
+    def save_channel(self, channel_id: str, address: str, channel: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO watch_channels "
+                "(channel_id, address, user_id, calendar_id, resource_id, expiration, token) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    channel_id,
+                    address,
+                    channel["user_id"],
+                    channel["calendar_id"],
+                    channel["resource_id"],
+                    channel["expiration"],
+                    channel.get("token"),
+                ),
+            )
+            # Expired channels are dead at Google as well.
+            self._conn.execute(
+                "DELETE FROM watch_channels WHERE expiration <= ?", (time.time(),)
+            )
+
+    def delete_channel(self, channel_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM watch_channels WHERE channel_id = ?", (channel_id,)
+            )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide store for ``STATE_BACKEND``, opening it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if STATE_BACKEND == "redis":
+                    from redis_state_store import RedisStateStore
+
+                    _store = RedisStateStore()
+                else:
+                    _store = StateStore()
+    return _store
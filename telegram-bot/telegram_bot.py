@@ -1,75 +1,135 @@
 import os
 import re
 import json
+import time
 import asyncio
 import traceback
-from pathlib import Path
 
-import aiohttp.web as web
 from dotenv import load_dotenv
+
+# Before the local imports below: they read their settings at import time.
+load_dotenv()
+
+import aiohttp.web as web
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from anthropic import Anthropic
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
 
 from create_event import (
+    SERVICE_CACHE_SIZE,
     authenticate_google_calendar,
+    batch_mutate,
+    event_body,
+    update_body,
     create_event,
-    find_event,
     delete_event,
     update_event,
     start_auth_flow,
     finish_auth_flow,
+    invalidate_user_service,
+    user_id_from_state,
     list_calendars,
+    list_events,
     load_user_calendar_id,
     store_user_calendar_id,
 )
 
+import calendar_gateway
+from calendar_watch import (
+    CHANNEL_CHECK_INTERVAL,
+    NOTIFY_PATH,
+    calendar_notify,
+    push_enabled,
+    renew_channels,
+)
+from event_cache import (
+    DELETE_MIN_SIMILARITY,
+    MIN_MATCH_SIMILARITY,
+    PROXIMITY_WEIGHT,
+    get_cache,
+    parse_event_time,
+)
+from event_watcher import (
+    POLL_INTERVAL,
+    cache_max_age,
+    check_event_changes,
+    polls_user,
+    renew_poll_leases,
+)
 from helpers.colors import emoji_for_color
-
-load_dotenv()
+from helpers.intent_parser import command_key, parse_intent
+from helpers.schedule_render import render_schedule
+from helpers.ttl_cache import TTLCache
+from llm_client import complete_text, get_client, stream_text
+from metrics import (
+    INTENT_CACHE_LOOKUPS,
+    TimedRequest,
+    log,
+    metrics_handler,
+    request_scope,
+    span,
+)
+from poll_leases import LEASE_RENEW_INTERVAL, PollLeases
+from prompts import cached_system, load_prompts
+from outbox import Outbox, outbox_notifier
+from reminders import REMINDERS_ENABLED, ReminderScheduler
+from request_queue import RequestQueue
+from shard_workers import SHARD_WORKERS, ShardWorkers
+from state_store import get_store
+from telegram_webhook import (
+    WEBHOOK_PATH,
+    register_webhook,
+    telegram_update,
+    webhook_enabled,
+)
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-ai_client = Anthropic()
 ACCESS_CODE = os.getenv("BOT_ACCESS_CODE", "")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+# How far ahead delete/update look for the event being referred to.
+FIND_HORIZON = timedelta(days=int(os.getenv("FIND_HORIZON_DAYS", 7)))
+# Commands the local parser is at least this sure about skip the LLM.
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "1") == "1"
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PATH_MIN_CONFIDENCE", 0.8))
+# Parsed LLM intents keyed on (normalized command, today); relative dates
+# make the date part of the key.
+INTENT_CACHE = TTLCache(
+    maxsize=int(os.getenv("INTENT_CACHE_SIZE", 2048)),
+    ttl=float(os.getenv("INTENT_CACHE_TTL", 6 * 3600)),
+)
+# Stream schedule summaries into a single message that is edited as text
+# arrives; edits are throttled to respect Telegram's per-chat limits.
+SUMMARY_STREAMING = os.getenv("SUMMARY_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+# "local" renders summaries without the LLM, "rich" always uses it and
+# "auto" renders locally up to SUMMARY_LOCAL_MAX_EVENTS events. Users can
+# override the default with /summary.
+SUMMARY_MODES = ("auto", "local", "rich")
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "auto")
+SUMMARY_LOCAL_MAX_EVENTS = int(os.getenv("SUMMARY_LOCAL_MAX_EVENTS", 6))
+# Calendar services built in the background after startup, at most this
+# many at a time so real requests still find free Calendar workers.
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", 4))
 
-BASE_DIR = Path(__file__).resolve().parent
 LOCAL_TZ = ZoneInfo("Asia/Jerusalem")
-TOKEN_DIR = BASE_DIR / "tokens"
-APPROVED_USERS_FILE = TOKEN_DIR / "approved_users.json"
 
 
-def load_approved_users() -> set:
-    if not APPROVED_USERS_FILE.exists():
-        return set()
-    try:
-        with open(APPROVED_USERS_FILE, "r") as f:
-            return set(json.load(f))
-    except (json.JSONDecodeError, OSError):
-        return set()
-
-
-def save_approved_user(user_id: int, bot_data: dict) -> None:
-    TOKEN_DIR.mkdir(exist_ok=True)
-    approved = bot_data.setdefault("approved_users", load_approved_users())
-    approved.add(user_id)
-    with open(APPROVED_USERS_FILE, "w") as f:
-        json.dump(list(approved), f)
-
+def save_approved_user(user_id: int) -> None:
+    get_store().add_approved_user(user_id)
 
-def is_user_approved(user_id: int, bot_data: dict) -> bool:
-    if "approved_users" not in bot_data:
-        bot_data["approved_users"] = load_approved_users()
-    return user_id in bot_data["approved_users"]
 
-with open(BASE_DIR / "notification_templates.json", "r", encoding="utf-8") as f:
-    TEMPLATES = json.load(f)
+def is_user_approved(user_id: int) -> bool:
+    return get_store().is_approved(user_id)
 
 
 def extract_json(text: str) -> dict:
@@ -79,62 +139,230 @@ def extract_json(text: str) -> dict:
     raise ValueError(f"No JSON found in response: {text[:200]}")
 
 
-def render_message(key, **kwargs):
-    template = TEMPLATES.get(key, "")
-    return template.format(**kwargs)
+async def load_events(context, user_id: int, service, calendar_id: str, start, end) -> list:
+    """Events overlapping ``[start, end)``, from the event cache when fresh.
+
+    A miss lists the range from Google and stores it in the cache.
+    """
+    cache = get_cache(user_id, calendar_id)
+    start_ts, end_ts = start.timestamp(), end.timestamp()
+    if cache.covers(start_ts, end_ts, cache_max_age(context.bot_data, user_id)):
+        return cache.between(start_ts, end_ts)
+    events = await calendar_gateway.run(
+        user_id,
+        list_events,
+        service,
+        start.astimezone(timezone.utc).isoformat(),
+        end.astimezone(timezone.utc).isoformat(),
+        calendar_id,
+    )
+    cache.replace_range(events, start_ts, end_ts)
+    return events
+
+
+def _parse_start_time(start_time) -> datetime | None:
+    try:
+        return datetime.strptime(start_time, "%Y-%m-%d %H:%M").replace(tzinfo=LOCAL_TZ)
+    except (TypeError, ValueError):
+        return None
 
 
-def time_date_strings(start_str: str):
+async def find_event_cached(
+    context, user_id: int, service, calendar_id: str, text, start_time=None, proximity=1.0,
+    day=None, min_similarity=MIN_MATCH_SIMILARITY,
+):
+    """Best match for ``text`` among upcoming events.
+
+    Looks ``FIND_HORIZON`` ahead (further if ``start_time`` is later) and
+    ranks candidates by title similarity, preferring events that start
+    near ``start_time``. ``proximity`` scales that preference. ``day`` (an
+    ISO date) restricts the search to events on that local day; titles less
+    similar than ``min_similarity`` never match.
+    """
+    if not text:
+        return None
+    now = datetime.now(timezone.utc)
+    target = _parse_start_time(start_time)
+    start = now
     try:
-        dt = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
+        day = date.fromisoformat(day) if day else None
     except ValueError:
-        return start_str, start_str
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    local = dt.astimezone(LOCAL_TZ)
-    return local.strftime("%H:%M"), local.strftime("%d/%m")
+        day = None
+    if day is not None:
+        start = max(now, datetime.combine(day, datetime.min.time(), LOCAL_TZ))
+        horizon = day
+    else:
+        horizon = now + FIND_HORIZON
+        if target and target > horizon:
+            horizon = target
+        horizon = horizon.astimezone(LOCAL_TZ).date()
+    # Round the horizon up to local midnight so repeated lookups during the
+    # day ask for the same range and hit the cache.
+    end = datetime.combine(horizon + timedelta(days=1), datetime.min.time(), LOCAL_TZ)
+    if start >= end:
+        return None
+    await load_events(context, user_id, service, calendar_id, start, end)
+    ranked = get_cache(user_id, calendar_id).rank(
+        text,
+        start.timestamp(),
+        end.timestamp(),
+        target_ts=target.timestamp() if target else None,
+        proximity_weight=PROXIMITY_WEIGHT * proximity,
+        min_similarity=min_similarity,
+    )
+    return ranked[0][1] if ranked else None
+
+
+def _shifted_times(event: dict, minutes: int) -> dict:
+    """``start``/``end`` moved by ``minutes``; empty for all-day events."""
+    times = {}
+    for field in ("start", "end"):
+        value = event.get(field, {})
+        if not value.get("dateTime"):
+            return {}
+        moved = parse_event_time(value) + timedelta(minutes=minutes)
+        times[field] = {**value, "dateTime": moved.isoformat()}
+    return times
+
+
+async def resolve_operations(context, user_id: int, service, calendar_id: str, operations):
+    """Turn the operations of a "batch" command into calendar mutations.
+
+    Operations with a ``date`` apply to every event that day whose title
+    matches ``summary`` (all of them when it is empty); updates of that
+    kind can only shift the time and change the color. Other operations
+    are resolved like the single create/delete/update commands.
+    """
+    resolved = []
+    for op in operations:
+        action = op.get("action")
+        if action == "create":
+            resolved.append({
+                "action": "create",
+                "body": event_body(
+                    op.get("summary"),
+                    op.get("start_time"),
+                    op.get("duration_minutes") or 60,
+                    op.get("color_id", ""),
+                ),
+            })
+            continue
+        if action not in ("delete", "update"):
+            continue
+        min_similarity = DELETE_MIN_SIMILARITY if action == "delete" else MIN_MATCH_SIMILARITY
+
+        if op.get("date"):
+            day = datetime.fromisoformat(op["date"]).replace(tzinfo=LOCAL_TZ)
+            day_end = day + timedelta(days=1)
+            events = await load_events(context, user_id, service, calendar_id, day, day_end)
+            if op.get("summary"):
+                ranked = get_cache(user_id, calendar_id).rank(
+                    op["summary"], day.timestamp(), day_end.timestamp(),
+                    min_similarity=min_similarity,
+                )
+                events = [event for _, event in ranked]
+        else:
+            event = await find_event_cached(
+                context, user_id, service, calendar_id, op.get("summary"),
+                op.get("start_time"), proximity=0.5 if action == "update" else 1.0,
+                min_similarity=min_similarity,
+            )
+            events = [event] if event else []
 
+        for event in events:
+            if action == "delete":
+                resolved.append({"action": "delete", "event_id": event["id"]})
+                continue
+            if op.get("date"):
+                body = _shifted_times(event, int(op.get("shift_minutes") or 0))
+                if op.get("color_id"):
+                    body["colorId"] = str(op["color_id"])
+            else:
+                body = update_body(op)
+            if body:
+                resolved.append({
+                    "action": "update",
+                    "event_id": event["id"],
+                    "etag": event.get("etag"),
+                    "body": body,
+                })
+    return resolved
+
+
+async def parse_with_llm(update: Update, text: str, today) -> dict:
+    """Parse ``text`` with the LLM, reusing cached intents for repeats."""
+    key = (command_key(text), today.isoformat())
+    data = INTENT_CACHE.get(key)
+    INTENT_CACHE_LOOKUPS.inc(result="miss" if data is None else "hit")
+    if data is not None:
+        return dict(data)
 
-def within_next_24h(start_str: str) -> bool:
-    try:
-        if "T" in start_str:
-            dt = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
-        else:
-            dt = datetime.fromisoformat(start_str)
-    except ValueError:
-        return False
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    dt_utc = dt.astimezone(timezone.utc)
-    diff = (dt_utc - datetime.now(timezone.utc)).total_seconds()
-    return 0 <= diff <= 24 * 3600
+    await update.message.reply_text("🧠 מעבד את הפקודה...")
+
+    with span("llm_parse"):
+        reply = await complete_text(
+            max_tokens=512,
+            system=cached_system("intent"),
+            messages=[{"role": "user", "content": f"התאריך היום הוא {today.isoformat()}. הפקודה היא: {text}"}],
+            temperature=0,
+        )
+    data = extract_json(reply)
+    INTENT_CACHE.set(key, dict(data))
+    return data
+
+
+def can_coalesce(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Only plain commands may be merged, not access codes or calendar picks."""
+    return (
+        is_user_approved(update.effective_user.id)
+        and "calendar_selection" not in context.user_data
+        and not update.message.text.strip().isdigit()
+    )
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.bot_data.setdefault("chat_id", update.effective_chat.id)
-    context.bot_data["user_id"] = update.effective_user.id
-    user_id = context.bot_data["user_id"]
-    text = update.message.text
+    """Queue the message behind the user's earlier ones."""
+    queue = context.bot_data["request_queue"]
+    if not queue.submit(update.effective_user.id, update, context):
+        await update.message.reply_text("⏳ יש כבר כמה פקודות בטיפול, נסה שוב בעוד רגע.")
+
+
+async def process_message(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, coalesced: bool = False
+):
+    """Handle one message, or a burst of them joined by newlines."""
+    with request_scope("message", user_id=update.effective_user.id, coalesced=coalesced):
+        await _process_message(update, context, text, coalesced)
+
 
-    if not is_user_approved(user_id, context.bot_data):
+async def _process_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, coalesced: bool):
+    user_id = update.effective_user.id
+    store = get_store()
+    store.set_chat_id(user_id, update.effective_chat.id)
+    store.touch_user(user_id)
+
+    with span("approval"):
+        approved = is_user_approved(user_id)
+    if not approved:
         if text.strip() == ACCESS_CODE and ACCESS_CODE:
-            save_approved_user(user_id, context.bot_data)
+            save_approved_user(user_id)
             await update.message.reply_text("✅ קוד אושר! ברוך הבא לבוט.")
         else:
             await update.message.reply_text("🔒 הבוט מוגן. אנא הכנס את קוד הגישה.")
         return
 
-    service = authenticate_google_calendar(user_id)
+    service = await calendar_gateway.run(
+        user_id, authenticate_google_calendar, user_id, stage="credentials"
+    )
     if not service:
         try:
-            auth_url, flow = start_auth_flow(user_id)
+            auth_url, flow_state = start_auth_flow(user_id)
         except Exception as e:
             await update.message.reply_text(f"❌ שגיאה בתהליך ההרשאה: {e}")
             return
-        context.bot_data.setdefault("pending_auth", {})[user_id] = {
-            "chat_id": update.effective_chat.id,
-            "flow": flow,
-        }
+        # Stored rather than kept in memory, so the callback may reach any
+        # instance.
+        get_store().set_pending_auth(user_id, update.effective_chat.id, flow_state)
         await update.message.reply_text(
             f"👋 כדי להשתמש בבוט יש לאשר גישה ליומן:\n{auth_url}\n\nלאחר האישור תקבל הודעה אוטומטית כאן."
         )
@@ -163,7 +391,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     calendar_id = load_user_calendar_id(user_id) if user_id else "primary"
     if user_id and not calendar_id:
-        calendars = list_calendars(service)
+        calendars = await calendar_gateway.run(user_id, list_calendars, service)
         if not calendars:
             await update.message.reply_text("❌ לא נמצאו יומנים בחשבון.")
             return
@@ -183,23 +411,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not calendar_id:
         calendar_id = "primary"
 
-    await update.message.reply_text("🧠 מעבד את הפקודה...")
-
-    with open(BASE_DIR / "xo_assistance_prompt.txt", "r", encoding="utf-8") as f:
-        base = f.read()
-    system_prompt = base
-
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = datetime.now(LOCAL_TZ).date()
+    # A burst may hold several commands; only the LLM can split it.
+    if FAST_PATH_ENABLED and not coalesced:
+        data, confidence = parse_intent(text, today)
+    else:
+        data, confidence = None, 0.0
 
     try:
-        resp = ai_client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=512,
-            system=system_prompt,
-            messages=[{"role": "user", "content": f"התאריך היום הוא {today}. הפקודה היא: {text}"}],
-            temperature=0,
-        )
-        data = extract_json(resp.content[0].text)
+        if data is None or confidence < FAST_PATH_MIN_CONFIDENCE:
+            data = await parse_with_llm(update, text, today)
 
         action = data.get("action")
         summary = data.get("summary")
@@ -220,50 +441,167 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await send_schedule_for_date(update, context, service, calendar_id, date_obj)
             return
 
+        cache = get_cache(user_id, calendar_id)
+
         if action == "create":
-            create_event(
+            created = await calendar_gateway.run(
+                user_id,
+                create_event,
                 service,
                 summary,
                 start_time,
                 duration,
                 color_id,
                 calendar_id=calendar_id,
+                retry_server_errors=False,
             )
+            cache.upsert(created)
             await update.message.reply_text("✅ אירוע נוצר עם צבע לפי הסיווג.")
 
         elif action == "delete":
-            event = find_event(service, summary, calendar_id=calendar_id)
+            event = await find_event_cached(
+                context, user_id, service, calendar_id, summary, start_time,
+                day=data.get("date"), min_similarity=DELETE_MIN_SIMILARITY,
+            )
             if event:
-                delete_event(service, event["id"], calendar_id=calendar_id)
+                await calendar_gateway.run(
+                    user_id, delete_event, service, event["id"], calendar_id=calendar_id
+                )
+                cache.remove(event["id"])
                 await update.message.reply_text("🗑️ האירוע נמחק בהצלחה!")
             else:
                 await update.message.reply_text("❌ לא נמצא אירוע למחיקה.")
 
         elif action == "update":
-            event = find_event(service, summary, calendar_id=calendar_id)
+            # start_time is where the event moves to, usually near where it
+            # is now, so it only nudges the ranking.
+            event = await find_event_cached(
+                context, user_id, service, calendar_id, summary, start_time, proximity=0.5
+            )
             if event:
-                update_event(service, event["id"], data, calendar_id=calendar_id)
-                if color_id:
-                    service.events().patch(
-                        calendarId=calendar_id,
-                        eventId=event["id"],
-                        body={"colorId": str(color_id)},
-                        sendUpdates="none",
-                    ).execute()
+                try:
+                    updated = await calendar_gateway.run(
+                        user_id,
+                        update_event,
+                        service,
+                        event["id"],
+                        data,
+                        calendar_id=calendar_id,
+                        etag=event.get("etag"),
+                    )
+                except HttpError as e:
+                    if e.resp.status != 412:
+                        raise
+                    # Changed elsewhere since we read it; do not overwrite.
+                    current = await calendar_gateway.execute(
+                        user_id, service.events().get(calendarId=calendar_id, eventId=event["id"])
+                    )
+                    cache.upsert(current)
+                    await update.message.reply_text(
+                        "⚠️ האירוע השתנה בינתיים ביומן. בדוק אותו ושלח שוב את העדכון."
+                    )
+                    return
+                cache.upsert(updated)
                 await update.message.reply_text("✏️ האירוע עודכן בהצלחה!")
             else:
                 await update.message.reply_text("❌ לא נמצא אירוע לעדכון.")
 
+        elif action == "batch":
+            operations = await resolve_operations(
+                context, user_id, service, calendar_id, data.get("operations") or []
+            )
+            if not operations:
+                await update.message.reply_text("❌ לא נמצאו אירועים מתאימים.")
+                return
+            results = await calendar_gateway.run(
+                user_id,
+                batch_mutate,
+                service,
+                operations,
+                calendar_id=calendar_id,
+                retry_server_errors=False,
+            )
+            failed = 0
+            for op, (response, error) in zip(operations, results):
+                if error is not None:
+                    failed += 1
+                    log("batch_op_failed", action=op["action"], error=repr(error))
+                elif op["action"] == "delete":
+                    cache.remove(op["event_id"])
+                elif response:
+                    cache.upsert(response)
+            reply = f"✅ בוצעו {len(operations) - failed} פעולות."
+            if failed:
+                reply += f"\n⚠️ {failed} פעולות נכשלו."
+            await update.message.reply_text(reply)
+
         else:
             await update.message.reply_text("❌ פעולה לא מזוהה.")
 
+    except asyncio.TimeoutError:
+        log("llm_timeout", stage="message")
+        await update.message.reply_text("⌛ השרת עמוס כרגע, נסה שוב בעוד רגע.")
+    except RefreshError:
+        invalidate_user_service(user_id)
+        await update.message.reply_text("🔑 ההרשאה ליומן פגה. שלח שוב את הפקודה כדי לאשר מחדש.")
     except Exception as e:
         error_message = f"❌ שגיאה: {e}"
-        print("Error while handling message:", e)
+        log("message_failed", error=repr(e))
         traceback.print_exc()
         await update.message.reply_text(error_message)
 
 
+def format_summary(text: str) -> str:
+    return text.replace("\n- ", "\n\n- ").strip()
+
+
+async def _edit_streamed(message, text: str) -> float:
+    """Edit ``message``; return extra seconds to wait before the next edit."""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        return float(e.retry_after)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return 0.0
+
+
+async def stream_reply(update: Update, chunks) -> None:
+    """Show a streamed completion as one progressively edited message.
+
+    Edits are spaced at least ``STREAM_EDIT_INTERVAL`` seconds apart (longer
+    when Telegram answers with RetryAfter); the last edit applies
+    :func:`format_summary` to the complete text.
+    """
+    message = None
+    text = ""
+    shown = ""
+    next_edit = 0.0
+    async for chunk in chunks:
+        text += chunk
+        if not text.strip():
+            continue
+        now = time.monotonic()
+        if message is None:
+            message = await update.message.reply_text(text)
+            shown = text
+            next_edit = now + STREAM_EDIT_INTERVAL
+        elif now >= next_edit:
+            backoff = await _edit_streamed(message, text)
+            shown = text
+            next_edit = now + STREAM_EDIT_INTERVAL + backoff
+
+    final = format_summary(text)
+    if message is None:
+        await update.message.reply_text(final or "📭 לא התקבל סיכום.")
+    elif final != shown:
+        backoff = next_edit - time.monotonic()
+        if backoff > STREAM_EDIT_INTERVAL:
+            await asyncio.sleep(backoff - STREAM_EDIT_INTERVAL)
+        await _edit_streamed(message, final)
+
+
 async def send_schedule_for_date(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -278,15 +616,9 @@ async def send_schedule_for_date(
         )
         end_local = start_local + timedelta(days=1)
 
-        events_result = service.events().list(
-            calendarId=calendar_id,
-            timeMin=start_local.astimezone(timezone.utc).isoformat(),
-            timeMax=end_local.astimezone(timezone.utc).isoformat(),
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-
-        events = events_result.get("items", [])
+        events = await load_events(
+            context, update.effective_user.id, service, calendar_id, start_local, end_local
+        )
         if not events:
             await update.message.reply_text(
                 f"📭 אין אירועים בתאריך {target_date.strftime('%d/%m/%Y')}."
@@ -295,6 +627,7 @@ async def send_schedule_for_date(
 
         # Format event list with exact time range and color emoji per event
         event_lines = []
+        color_ids = []
         for event in events:
             summary = event.get("summary", "ללא כותרת")
             emoji = emoji_for_color(event.get("colorId"))
@@ -309,108 +642,69 @@ async def send_schedule_for_date(
                 time_str = "אירוע יום שלם" if all_day else "זמן לא צוין"
             emoji_suffix = f" {emoji}" if emoji else ""
             event_lines.append(f"{time_str} - {summary}{emoji_suffix}")
+            color_ids.append(event.get("colorId"))
 
-        # Load prompt and inject requested date
         date_str = target_date.strftime("%d/%m/%Y")
-        with open(BASE_DIR / "summarize_schedule_prompt.txt", "r", encoding="utf-8") as f:
-            prompt_template = f.read()
-        prompt = prompt_template.replace("[תאריך]", date_str)
-        full_prompt = prompt + "\n" + "\n\n".join(event_lines)
+        mode = get_store().get_summary_mode(update.effective_user.id) or SUMMARY_MODE
+        if mode == "local" or (
+            mode == "auto" and len(events) <= SUMMARY_LOCAL_MAX_EVENTS
+        ):
+            with span("summary"):
+                rendered = render_schedule(date_str, event_lines, color_ids)
+            await update.message.reply_text(rendered)
+            return
 
-        response = ai_client.messages.create(
-            model="claude-haiku-4-5-20251001",
+        # The template stays static (and cacheable); the date and events go
+        # in the user turn.
+        user_prompt = f"[תאריך] = {date_str}\n" + "\n\n".join(event_lines)
+
+        request = dict(
             max_tokens=1024,
-            messages=[{"role": "user", "content": full_prompt}],
+            system=cached_system("summary"),
+            messages=[{"role": "user", "content": user_prompt}],
             temperature=0.3,
         )
+        if SUMMARY_STREAMING:
+            # Generation and the edits showing it overlap, so this span
+            # includes the Telegram time of the edits.
+            with span("summary"):
+                await stream_reply(update, stream_text(**request))
+            return
 
-        summary_text = response.content[0].text
-        summary_text = summary_text.replace("\n- ", "\n\n- ").strip()
+        with span("summary"):
+            summary_text = await complete_text(**request)
+        summary_text = format_summary(summary_text)
         await update.message.reply_text(summary_text)
 
+    except asyncio.TimeoutError:
+        log("llm_timeout", stage="summary")
+        await update.message.reply_text("⌛ השרת עמוס כרגע, נסה שוב בעוד רגע.")
     except Exception as e:
-        print("Error while sending schedule summary:", e)
+        log("summary_failed", error=repr(e))
         traceback.print_exc()
         await update.message.reply_text(f"❌ שגיאה: {str(e)}")
 
 
-async def check_event_changes(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.bot_data.get("chat_id")
-    if not chat_id:
+async def handle_summary_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/summary [auto|local|rich] - choose how daily schedules are written."""
+    user_id = update.effective_user.id
+    if not is_user_approved(user_id):
+        await update.message.reply_text("🔒 הבוט מוגן. אנא הכנס את קוד הגישה.")
         return
 
-    user_id = context.bot_data.get("user_id")
-    service = authenticate_google_calendar(user_id) if user_id else None
-    if not service:
+    store = get_store()
+    mode = context.args[0].lower() if context.args else ""
+    if mode not in SUMMARY_MODES:
+        current = store.get_summary_mode(user_id) or SUMMARY_MODE
+        await update.message.reply_text(
+            f"מצב הסיכום הנוכחי: {current}\n"
+            "שלח /summary local לסיכום מהיר, /summary rich לסיכום מנוסח "
+            "או /summary auto לבחירה אוטומטית."
+        )
         return
 
-    calendar_id = load_user_calendar_id(user_id) if user_id else "primary"
-    if user_id and not calendar_id:
-        return
-    if not calendar_id:
-        calendar_id = "primary"
-
-    try:
-        now = datetime.now(timezone.utc)
-        time_min = now.isoformat()
-        time_max = (now + timedelta(hours=24)).isoformat()
-
-        events_result = service.events().list(
-            calendarId=calendar_id,
-            timeMin=time_min,
-            timeMax=time_max,
-            singleEvents=True,
-            orderBy="startTime",
-        ).execute()
-
-        events = events_result.get("items", [])
-        tracked = context.bot_data.setdefault("tracked_events", {})
-        current_ids = set()
-
-        for ev in events:
-            ev_id = ev["id"]
-            current_ids.add(ev_id)
-            start = ev["start"].get("dateTime", ev["start"].get("date"))
-            summary = ev.get("summary", "ללא כותרת")
-            updated = ev.get("updated")
-            previous = tracked.get(ev_id)
-            if not previous:
-                tracked[ev_id] = {"updated": updated, "summary": summary, "start": start}
-            else:
-                has_meaningful_change = (
-                    previous.get("start") != start or previous.get("summary") != summary
-                )
-                if has_meaningful_change and previous.get("updated") != updated:
-                    old_time, old_date = time_date_strings(previous["start"])
-                    new_time, new_date = time_date_strings(start)
-                    tracked[ev_id] = {"updated": updated, "summary": summary, "start": start}
-                    msg = render_message(
-                        "event_updated",
-                        summary=summary,
-                        old_time=old_time,
-                        old_date=old_date,
-                        new_time=new_time,
-                        new_date=new_date,
-                    )
-                    await context.bot.send_message(chat_id=chat_id, text=msg)
-
-        removed = [eid for eid in list(tracked.keys()) if eid not in current_ids]
-        for eid in removed:
-            info = tracked.pop(eid)
-            if within_next_24h(info["start"]):
-                old_time, old_date = time_date_strings(info["start"])
-                msg = render_message(
-                    "event_deleted",
-                    summary=info["summary"],
-                    old_time=old_time,
-                    old_date=old_date,
-                )
-                await context.bot.send_message(chat_id=chat_id, text=msg)
-
-    except Exception as e:
-        print("Error while checking event changes:", e)
-        traceback.print_exc()
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ שגיאה בבדיקת אירועים: {e}")
+    store.set_summary_mode(user_id, mode)
+    await update.message.reply_text(f"✅ מצב הסיכום עודכן ל-{mode}.")
 
 
 async def oauth_callback(request: web.Request) -> web.Response:
@@ -421,13 +715,21 @@ async def oauth_callback(request: web.Request) -> web.Response:
         return web.Response(text="Missing parameters", status=400)
 
     try:
-        user_id = int(state)
+        user_id = user_id_from_state(state)
         ptb_app = request.app["ptb_app"]
-        pending = ptb_app.bot_data.get("pending_auth", {}).pop(user_id, {})
-        flow = pending.get("flow")
-        chat_id = pending.get("chat_id")
+        chat_id, flow_state = get_store().pop_pending_auth(user_id)
+
+        if flow_state is None or flow_state.get("state") != state:
+            # The link expired or was replaced by a newer one; the user has
+            # to start over with a fresh link.
+            if chat_id:
+                await ptb_app.bot.send_message(
+                    chat_id=chat_id,
+                    text="⚠️ תוקף קישור ההרשאה פג. שלח פקודה כדי לקבל קישור חדש.",
+                )
+            return web.Response(text="Authorization link expired", status=400)
 
-        finish_auth_flow(user_id, flow, code)
+        finish_auth_flow(user_id, flow_state, code)
 
         if chat_id:
             await ptb_app.bot.send_message(
@@ -445,14 +747,113 @@ async def oauth_callback(request: web.Request) -> web.Response:
         return web.Response(text=f"Error: {e}", status=500)
 
 
+async def healthz(request: web.Request) -> web.Response:
+    """Liveness: the process is up and serving HTTP."""
+    return web.Response(text="ok")
+
+
+async def readyz(request: web.Request) -> web.Response:
+    """Readiness: the bot is connected and taking updates."""
+    if not request.app["ptb_app"].bot_data.get("ready"):
+        return web.Response(text="starting", status=503)
+    return web.Response(text="ready")
+
+
+async def prewarm() -> None:
+    """Load the slow imports and users' Calendar services in the background.
+
+    Runs after the bot reports ready, so the first messages after a deploy
+    find the Anthropic client and the service cache already built.
+    """
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, get_client)
+    except Exception as e:
+        log("prewarm_failed", target="llm", error=repr(e))
+    # The service cache holds SERVICE_CACHE_SIZE users; fill it with the
+    # ones most likely to write soon.
+    users = get_store().recently_active_users()[:SERVICE_CACHE_SIZE]
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+    async def warm(user_id):
+        async with semaphore:
+            try:
+                await calendar_gateway.run(
+                    user_id, authenticate_google_calendar, user_id, stage="credentials"
+                )
+            except Exception as e:
+                log("prewarm_failed", user_id=user_id, error=repr(e))
+
+    await asyncio.gather(*(warm(u) for u in users))
+    log("prewarm_done", users=len(users), total_ms=round((time.monotonic() - started) * 1000, 1))
+
+
 async def run():
-    ptb_app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    ptb_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    ptb_app.job_queue.run_repeating(check_event_changes, interval=60, first=10)
+    # Fail fast on a missing or broken prompt rather than on the first message.
+    load_prompts()
+
+    # Handlers await the LLM instead of blocking, so let PTB run updates from
+    # different chats side by side rather than one at a time.
+    ptb_app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .request(TimedRequest(connection_pool_size=256))
+        .build()
+    )
+    ptb_app.add_handler(CommandHandler("summary", handle_summary_mode))
+    # Edits carry no update.message; only new messages are commands.
+    ptb_app.add_handler(
+        MessageHandler(
+            filters.TEXT & ~filters.COMMAND & ~filters.UpdateType.EDITED_MESSAGE,
+            handle_message,
+        )
+    )
+    store = get_store()
+    # Alerts and other bot-initiated messages go through a rate-limited queue.
+    outbox = Outbox(ptb_app.bot)
+    ptb_app.bot_data["outbox"] = outbox
+    request_queue = RequestQueue(process_message, can_coalesce)
+    ptb_app.bot_data["request_queue"] = request_queue
+    # Only the instance holding a shard's lease polls its users, so replicas
+    # do not send the same alert twice.
+    poll_leases = PollLeases(store)
+    ptb_app.bot_data["poll_leases"] = poll_leases
+    ptb_app.job_queue.run_repeating(
+        renew_poll_leases, interval=LEASE_RENEW_INTERVAL, first=0
+    )
+    shard_workers = None
+    if SHARD_WORKERS > 0:
+        # Polling and diffing run in worker processes instead of this loop.
+        shard_workers = ShardWorkers(SHARD_WORKERS, poll_leases.shards)
+        ptb_app.bot_data["shard_workers"] = shard_workers
+    else:
+        ptb_app.job_queue.run_repeating(
+            check_event_changes, interval=POLL_INTERVAL, first=10
+        )
+        if REMINDERS_ENABLED:
+            # Fed by the poll diffs; the workers keep their own otherwise.
+            ptb_app.bot_data["reminders"] = ReminderScheduler(
+                outbox_notifier(outbox),
+                ptb_app.job_queue,
+                owns=lambda user_id: polls_user(ptb_app.bot_data, user_id),
+            )
+    if push_enabled():
+        ptb_app.job_queue.run_repeating(
+            renew_channels, interval=CHANNEL_CHECK_INTERVAL, first=5
+        )
 
     aiohttp_app = web.Application()
     aiohttp_app["ptb_app"] = ptb_app
     aiohttp_app.router.add_get("/oauth/callback", oauth_callback)
+    aiohttp_app.router.add_get("/metrics", metrics_handler)
+    aiohttp_app.router.add_get("/healthz", healthz)
+    aiohttp_app.router.add_get("/readyz", readyz)
+    aiohttp_app.router.add_post(NOTIFY_PATH, calendar_notify)
+    use_webhook = webhook_enabled()
+    if use_webhook:
+        aiohttp_app.router.add_post(WEBHOOK_PATH, telegram_update)
 
     runner = web.AppRunner(aiohttp_app)
     await runner.setup()
@@ -462,13 +863,31 @@ async def run():
 
     async with ptb_app:
         await ptb_app.start()
-        await ptb_app.updater.start_polling()
-        print("🤖 הבוט מחובר לטלגרם ומחכה להודעות...")
+        request_queue.start()
+        outbox.start()
+        if shard_workers:
+            shard_workers.start(outbox)
+        if use_webhook:
+            await register_webhook(ptb_app.bot)
+        else:
+            await ptb_app.updater.start_polling()
+        ptb_app.bot_data["ready"] = True
+        warmup = asyncio.create_task(prewarm())
+        log("bot_started")
         try:
             await asyncio.Event().wait()
         finally:
-            await ptb_app.updater.stop()
+            # Fail readiness first so the load balancer stops sending traffic.
+            ptb_app.bot_data["ready"] = False
+            warmup.cancel()
+            if ptb_app.updater.running:
+                await ptb_app.updater.stop()
+            await request_queue.stop()
+            if shard_workers:
+                await shard_workers.stop()
+            await outbox.stop()
             await ptb_app.stop()
+            poll_leases.release_all()
             await runner.cleanup()
 
 
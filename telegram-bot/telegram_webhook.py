@@ -0,0 +1,70 @@
+import os
+import hmac
+
+import aiohttp.web as web
+from telegram import Update
+
+from metrics import log
+
+# "polling" (default) or "webhook". In webhook mode Telegram posts updates to
+# TELEGRAM_WEBHOOK_URL + WEBHOOK_PATH on the aiohttp server, so any number of
+# instances can sit behind one load balancer.
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+# Public https base URL Telegram can reach, e.g. https://bot.example.com.
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+# 1-256 characters of A-Z, a-z, 0-9, _ and -. Used both in the path and as
+# the secret token Telegram echoes in every request.
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+WEBHOOK_PATH = f"/telegram/{TELEGRAM_WEBHOOK_SECRET}"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_enabled() -> bool:
+    if TELEGRAM_MODE != "webhook":
+        return False
+    if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError(
+            "TELEGRAM_MODE=webhook needs TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET"
+        )
+    return True
+
+
+async def register_webhook(bot) -> None:
+    """Point Telegram at this deployment; safe to repeat from every instance."""
+    await bot.set_webhook(
+        url=TELEGRAM_WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    log("webhook_registered", url=TELEGRAM_WEBHOOK_URL + "/telegram/...")
+
+
+async def telegram_update(request: web.Request) -> web.Response:
+    """Receive an update from Telegram and hand it to the PTB application.
+
+    The update is only queued here, so Telegram gets its 200 right away
+    and handlers run exactly as they do with long polling.
+    """
+    token = request.headers.get(SECRET_HEADER, "")
+    if not hmac.compare_digest(token.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+
+    ptb_app = request.app["ptb_app"]
+    try:
+        data = await request.json()
+    except ValueError:
+        # Not JSON, or not even UTF-8.
+        return web.Response(text="Invalid JSON", status=400)
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return web.Response(text="Invalid update", status=400)
+    try:
+        update = Update.de_json(data, ptb_app.bot)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        update = None
+    if update is None:
+        return web.Response(text="Invalid update", status=400)
+    await ptb_app.update_queue.put(update)
+    return web.Response(status=200)
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Modules read their settings on import; keep test state out of tokens/.
+os.environ.setdefault(
+    "STATE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="xo-test-"), "state.db")
+)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
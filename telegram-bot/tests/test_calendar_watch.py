@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import calendar_watch
+from benchmarks.fakes import FakeCalendar, FakePushNotifier
+from state_store import get_store
+
+USER_ID = 4242
+DEBOUNCE = 0.05
+
+
+class FakeApp:
+    """The parts of the PTB application ``calendar_notify`` uses."""
+
+    def __init__(self):
+        self.bot_data = {}
+
+    def create_task(self, coro):
+        return asyncio.ensure_future(coro)
+
+
+@pytest.fixture
+def refreshed(monkeypatch):
+    calls = []
+
+    async def refresh_user(bot_data, user_id):
+        calls.append(user_id)
+
+    monkeypatch.setattr(calendar_watch, "refresh_user", refresh_user)
+    monkeypatch.setattr(calendar_watch, "PUSH_DEBOUNCE", DEBOUNCE)
+    monkeypatch.setattr(calendar_watch, "CALENDAR_WEBHOOK_URL", "https://bot.test")
+    return calls
+
+
+async def register(ptb_app, calendar_id="primary"):
+    """Open a channel for USER_ID; returns ``(channel_id, resource_id)``."""
+    await calendar_watch.ensure_channel(
+        ptb_app.bot_data, USER_ID, FakeCalendar().service(), calendar_id
+    )
+    channel_id = ptb_app.bot_data["user_channels"][USER_ID]
+    return channel_id, ptb_app.bot_data["watch_channels"][channel_id]["resource_id"]
+
+
+async def post(ptb_app, *notifications):
+    """Deliver ``(channel_id, resource_id, state, token)`` notifications.
+
+    Returns the HTTP statuses once the debounced refreshes had time to run.
+    """
+    app = web.Application()
+    app["ptb_app"] = ptb_app
+    app.router.add_post(calendar_watch.NOTIFY_PATH, calendar_watch.calendar_notify)
+    async with TestClient(TestServer(app)) as client:
+        notifier = FakePushNotifier(
+            client, calendar_watch.NOTIFY_PATH, calendar_watch.CALENDAR_WEBHOOK_TOKEN
+        )
+        statuses = [await notifier.notify(*notification) for notification in notifications]
+        await asyncio.sleep(DEBOUNCE * 3)
+    return statuses
+
+
+def test_sync_message_only_confirms_the_channel(refreshed):
+    async def scenario():
+        ptb_app = FakeApp()
+        channel_id, resource_id = await register(ptb_app)
+        return await post(ptb_app, (channel_id, resource_id, "sync"))
+
+    assert asyncio.run(scenario()) == [200]
+    assert refreshed == []
+
+
+def test_changes_refresh_the_owner_once_per_burst(refreshed):
+    async def scenario():
+        ptb_app = FakeApp()
+        channel_id, resource_id = await register(ptb_app)
+        return await post(
+            ptb_app,
+            (channel_id, resource_id, "exists"),
+            (channel_id, resource_id, "exists"),
+            (channel_id, resource_id, "not_exists"),
+        )
+
+    assert asyncio.run(scenario()) == [200, 200, 200]
+    assert refreshed == [USER_ID]
+
+
+def test_wrong_token_is_rejected(refreshed):
+    async def scenario():
+        ptb_app = FakeApp()
+        channel_id, resource_id = await register(ptb_app)
+        return await post(ptb_app, (channel_id, resource_id, "exists", "not-the-token"))
+
+    assert asyncio.run(scenario()) == [403]
+    assert refreshed == []
+
+
+def test_unknown_or_replaced_channels_are_acknowledged_and_ignored(refreshed):
+    async def scenario():
+        ptb_app = FakeApp()
+        old_channel, old_resource = await register(ptb_app)
+        # Switching calendars replaces the channel.
+        await register(ptb_app, "work")
+        assert old_channel not in get_store().load_channels("https://bot.test")
+        return await post(
+            ptb_app,
+            ("no-such-channel", "no-such-resource", "exists"),
+            (old_channel, old_resource, "exists"),
+        )
+
+    assert asyncio.run(scenario()) == [200, 200]
+    assert refreshed == []
+
+
+def test_channels_survive_a_restart(refreshed):
+    async def scenario():
+        channel_id, resource_id = await register(FakeApp())
+        assert channel_id in get_store().load_channels("https://bot.test")
+        # A new process starts with empty bot_data.
+        return await post(FakeApp(), (channel_id, resource_id, "exists"))
+
+    assert asyncio.run(scenario()) == [200]
+    assert refreshed == [USER_ID]
+
+
+def test_restart_with_a_new_token_still_accepts_old_channels(refreshed, monkeypatch):
+    async def scenario():
+        channel_id, resource_id = await register(FakeApp())
+        old_token = calendar_watch.CALENDAR_WEBHOOK_TOKEN
+        # Without CALENDAR_WEBHOOK_TOKEN every start draws a fresh token.
+        monkeypatch.setattr(calendar_watch, "CALENDAR_WEBHOOK_TOKEN", "token-of-the-new-process")
+        return await post(
+            FakeApp(),
+            (channel_id, resource_id, "exists", old_token),
+            (channel_id, resource_id, "exists", "token-of-the-new-process"),
+        )
+
+    assert asyncio.run(scenario()) == [200, 403]
+    assert refreshed == [USER_ID]
@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from benchmarks.fakes import FakeCalendar, make_events
+from create_event import update_event
+
+
+def test_update_of_an_event_changed_elsewhere_is_refused():
+    calendar = FakeCalendar(make_events(1, datetime.now(timezone.utc), timedelta(days=1)))
+    read = dict(calendar.events["ev000000"])
+    # Another client moves the event after the bot read it.
+    calendar.move("ev000000", 30)
+    moved = dict(calendar.events["ev000000"])
+
+    with pytest.raises(HttpError) as error:
+        update_event(
+            calendar.service(), "ev000000", {"summary": "פגישה חדשה"}, etag=read["etag"]
+        )
+
+    assert error.value.resp.status == 412
+    assert calendar.events["ev000000"] == moved
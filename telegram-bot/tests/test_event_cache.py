@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import event_cache
+from event_cache import DELETE_MIN_SIMILARITY, EventCache
+
+DAY = 24 * 3600
+NOW = 1_800_000_000.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock the test moves by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(event_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_relisting_part_of_a_range_keeps_the_rest_stale(clock):
+    cache = EventCache()
+    cache.replace_range([], NOW, NOW + 7 * DAY)
+    clock[0] += 600
+    cache.replace_range([], NOW, NOW + DAY)
+
+    assert cache.covers(NOW + 60, NOW + DAY, max_age=120)
+    assert not cache.covers(NOW + 60, NOW + 7 * DAY, max_age=120)
+    assert not cache.covers(NOW + 2 * DAY, NOW + 3 * DAY, max_age=120)
+    assert cache.covers(NOW + 2 * DAY, NOW + 3 * DAY, max_age=900)
+
+
+def test_change_feed_confirms_every_range(clock):
+    cache = EventCache()
+    cache.replace_range([], NOW, NOW + 7 * DAY)
+    clock[0] += 600
+    cache.replace_range([], NOW, NOW + DAY)
+    cache.mark_synced()
+
+    assert cache.covers(NOW, NOW + 7 * DAY, max_age=120)
+    assert not cache.covers(NOW - DAY, NOW + DAY, max_age=120)
+
+
+def event(event_id, summary, start=NOW + 3600):
+    def at(ts):
+        return {"dateTime": datetime.fromtimestamp(ts, timezone.utc).isoformat()}
+
+    return {"id": event_id, "summary": summary, "start": at(start), "end": at(start + 1800)}
+
+
+def test_delete_needs_a_near_exact_title():
+    cache = EventCache()
+    cache.apply([event("team", "ישיבת צוות"), event("demo", "הדגמה ללקוח")])
+
+    def delete_matches(text):
+        ranked = cache.rank(text, NOW, NOW + DAY, min_similarity=DELETE_MIN_SIMILARITY)
+        return [e["id"] for _, e in ranked]
+
+    # A loose match is fine for finding an event, not for deleting it.
+    assert [e["id"] for _, e in cache.rank("ישיבה", NOW, NOW + DAY)] == ["team"]
+    assert delete_matches("ישיבה") == []
+    assert delete_matches("ישיבת צוות") == ["team"]
+    assert delete_matches("הדגמה") == ["demo"]
@@ -0,0 +1,29 @@
+from datetime import date
+
+import pytest
+
+from helpers.intent_parser import parse_intent
+
+TODAY = date(2026, 10, 17)
+
+
+@pytest.mark.parametrize("text, minutes", [
+    ("קבע פגישה מחר ב-10:00 למשך 20 דקות", 20),
+    ("קבע פגישה מחר ב-10:00 ל-15 דקות", 15),
+    ("קבע פגישה מחר ב-10:00 ל15 דקות", 15),
+    ("קבע פגישה מחר ב-10:00 ל-2 שעות", 120),
+    ("קבע פגישה מחר ב-10:00 לשעתיים", 120),
+    ("קבע פגישה מחר ב-10:00 לשעה וחצי", 90),
+])
+def test_duration_is_taken_out_of_the_title(text, minutes):
+    data, confidence = parse_intent(text, TODAY)
+    assert data["summary"] == "פגישה"
+    assert data["duration_minutes"] == minutes
+    assert data["start_time"] == "2026-10-18 10:00"
+    assert confidence == 0.9
+
+
+def test_hour_after_le_is_a_start_time_not_a_duration():
+    data, _ = parse_intent("קבע פגישה מחר לשעה 10", TODAY)
+    assert data["start_time"] == "2026-10-18 10:00"
+    assert data["duration_minutes"] == 60
@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import request_queue
+from request_queue import RequestQueue
+
+WINDOW = 0.05
+
+
+@pytest.fixture(autouse=True)
+def window(monkeypatch):
+    monkeypatch.setattr(request_queue, "COALESCE_WINDOW", WINDOW)
+    monkeypatch.setattr(request_queue, "QUEUE_WORKERS", 2)
+
+
+def message(text):
+    return SimpleNamespace(effective_message=SimpleNamespace(text=text))
+
+
+async def run(*batches, can_coalesce=lambda update, context: True):
+    """Submit ``(delay, text)`` pairs for one user; returns the handler calls."""
+    calls = []
+
+    async def handler(update, context, text, coalesced):
+        calls.append((text, coalesced))
+
+    queue = RequestQueue(handler, can_coalesce)
+    queue.start()
+    for delay, text in batches:
+        await asyncio.sleep(delay)
+        assert queue.submit(1, message(text), None)
+    await asyncio.sleep(WINDOW * 4)
+    await queue.stop()
+    return calls
+
+
+def test_messages_a_few_ms_apart_make_one_call():
+    calls = asyncio.run(run((0, "קבע פגישה מחר"), (0.005, "בשעה 10")))
+    assert calls == [("קבע פגישה מחר\nבשעה 10", True)]
+
+
+def test_messages_further_apart_are_handled_separately():
+    calls = asyncio.run(run((0, "סכם את היום"), (WINDOW * 3, "סכם את מחר")))
+    assert calls == [("סכם את היום", False), ("סכם את מחר", False)]
+
+
+def test_messages_that_cannot_be_merged_are_not_held():
+    async def scenario():
+        calls = []
+
+        async def handler(update, context, text, coalesced):
+            calls.append(text)
+
+        queue = RequestQueue(handler)
+        queue.start()
+        queue.submit(1, message("1234"), None)
+        await asyncio.sleep(WINDOW / 5)
+        await queue.stop()
+        return calls
+
+    assert asyncio.run(scenario()) == ["1234"]
@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Bot
+
+import telegram_webhook
+from benchmarks.fakes import FakeTelegramPoster
+
+SECRET = "test-secret"
+
+
+async def post(*bodies, secret=None):
+    """Post ``bodies`` to the webhook; returns the statuses and queued updates."""
+    ptb_app = SimpleNamespace(bot=Bot("123:test"), update_queue=asyncio.Queue())
+    app = web.Application()
+    app["ptb_app"] = ptb_app
+    app.router.add_post(telegram_webhook.WEBHOOK_PATH, telegram_webhook.telegram_update)
+    async with TestClient(TestServer(app)) as client:
+        poster = FakeTelegramPoster(client, telegram_webhook.WEBHOOK_PATH, SECRET)
+        statuses = []
+        for body in bodies:
+            body = poster.message(*body) if isinstance(body, tuple) else body
+            statuses.append(await poster.post(body, secret=secret))
+    queued = []
+    while not ptb_app.update_queue.empty():
+        queued.append(ptb_app.update_queue.get_nowait())
+    return statuses, queued
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_SECRET", SECRET)
+
+
+def test_valid_update_reaches_the_update_queue():
+    statuses, queued = asyncio.run(post((7, "סכם את מחר")))
+    assert statuses == [200]
+    assert len(queued) == 1
+    assert queued[0].message.text == "סכם את מחר"
+    assert queued[0].effective_user.id == 7
+
+
+def test_wrong_secret_is_rejected():
+    statuses, queued = asyncio.run(post((7, "hi"), secret="wrong"))
+    assert statuses == [403]
+    assert queued == []
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"{not json",
+        b"\xff\xfe",
+        [1, 2, 3],
+        {},
+        {"update_id": "1"},
+        {"update_id": 1, "message": "not an object"},
+    ],
+)
+def test_malformed_body_is_a_bad_request(body):
+    statuses, queued = asyncio.run(post(body))
+    assert statuses == [400]
+    assert queued == []
@@ -0,0 +1,139 @@
+import heapq
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from event_cache import LOCAL_TZ, parse_event_time
+
+
+class TrackedEvent:
+    """What the change poller remembers about one event.
+
+    ``start``/``end`` are epoch seconds; titles are compared by hash and the
+    text is kept only for the "deleted" alert.
+    """
+
+    __slots__ = ("start", "end", "title_hash", "updated", "summary")
+
+    def __init__(self, start: float, end: float, summary: str, updated):
+        self.start = start
+        self.end = end
+        self.title_hash = hash(summary)
+        self.updated = updated
+        self.summary = summary
+
+    def row(self) -> dict:
+        """The persisted form (the ``tracked_events`` columns)."""
+        return {
+            "updated": self.updated,
+            "summary": self.summary,
+            "start": datetime.fromtimestamp(self.start, timezone.utc).isoformat(),
+        }
+
+
+def parse_start(value: str) -> float | None:
+    """Epoch seconds of a stored start: an RFC 3339 time or an all-day date."""
+    if not value:
+        return None
+    try:
+        if "T" in value:
+            return parse_event_time({"dateTime": value}).timestamp()
+        return parse_event_time({"date": value}).timestamp()
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def local_strings(ts: float) -> tuple:
+    """``("HH:MM", "DD/MM")`` of ``ts`` in local time."""
+    local = datetime.fromtimestamp(ts, LOCAL_TZ)
+    return local.strftime("%H:%M"), local.strftime("%d/%m")
+
+
+class TrackedEvents:
+    """Tracked events of one calendar, with a min-heap of end times.
+
+    Events leave the poll window when they end, so :meth:`pop_expired`
+    finds them without scanning every record. Heap entries are not removed
+    when a record changes or goes away; stale ones are skipped when popped.
+    Changes since the last :meth:`take_changes` are recorded so only they
+    are persisted.
+    """
+
+    def __init__(self, rows: dict | None = None):
+        self._events: dict = {}
+        self._heap: list = []
+        self._dirty: set = set()
+        self._removed: set = set()
+        for event_id, info in (rows or {}).items():
+            start = parse_start(info.get("start"))
+            if start is None:
+                continue
+            # The end is not stored; an event still running is rescheduled
+            # with its real end by the first poll that lists it.
+            record = TrackedEvent(start, start, info.get("summary") or "", info.get("updated"))
+            self._events[event_id] = record
+            self._heap.append((record.end, event_id))
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __contains__(self, event_id) -> bool:
+        return event_id in self._events
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def get(self, event_id) -> TrackedEvent | None:
+        return self._events.get(event_id)
+
+    def items(self):
+        return self._events.items()
+
+    def set(self, event_id, record: TrackedEvent) -> None:
+        previous = self._events.get(event_id)
+        self._events[event_id] = record
+        if previous is None or previous.end != record.end:
+            self._push(record.end, event_id)
+        self._dirty.add(event_id)
+        self._removed.discard(event_id)
+
+    def reschedule(self, event_id, end: float) -> None:
+        """Correct the end of a record without marking it changed."""
+        record = self._events[event_id]
+        if record.end != end:
+            record.end = end
+            self._push(end, event_id)
+
+    def remove(self, event_id) -> TrackedEvent | None:
+        record = self._events.pop(event_id, None)
+        if record is not None:
+            self._dirty.discard(event_id)
+            self._removed.add(event_id)
+        return record
+
+    def pop_expired(self, now_ts: float):
+        """Yield ``(event_id, record)`` for records that ended by ``now_ts``.
+
+        The caller removes or reschedules each one.
+        """
+        while self._heap and self._heap[0][0] <= now_ts:
+            end, event_id = heapq.heappop(self._heap)
+            record = self._events.get(event_id)
+            if record is not None and record.end == end:
+                yield event_id, record
+
+    def take_changes(self) -> tuple:
+        """``(changed rows, removed ids)`` since the previous call."""
+        changed = {event_id: self._events[event_id].row() for event_id in self._dirty}
+        removed = list(self._removed)
+        self._dirty.clear()
+        self._removed.clear()
+        return changed, removed
+
+    def _push(self, end: float, event_id) -> None:
+        heapq.heappush(self._heap, (end, event_id))
+        if len(self._heap) > 2 * len(self._events) + 64:
+            # Mostly stale entries; rebuild from the live records.
+            self._heap = [(record.end, eid) for eid, record in self._events.items()]
+            heapq.heapify(self._heap)